@@ -0,0 +1,166 @@
+# changes: Scheduler8.run used time.sleep(delta) when nothing was ready
+#
+# time.sleep blocks EVERYTHING, even our own scheduler!
+# while we sleep until the next timer, nobody can notice that a socket received data
+# the operating system already knows how to wait for "a timer OR some sockets": select/epoll/kqueue
+# Python's `selectors` module picks the best one for us (selectors.DefaultSelector)
+#
+# new idea: a task that wants to read a socket disappears from the ready queue (like sleep() does)
+# and its coroutine is stored inside the selector until the OS tells us the socket is readable
+import heapq
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class Scheduler11:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        # tasks waiting for a socket (file descriptor) to become readable or writable
+        self.selector = selectors.DefaultSelector()
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    async def sleep(self, delay):
+        deadline = time.time() + delay
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (deadline, self.sequence, self.current))
+        self.current = None  # disappear
+        await switch()  # go to next task
+
+    def _wait_io(self, fileobj, event):
+        # each socket stores at most one reader and one writer: [reader, writer]
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None  # disappear until the socket is ready
+
+    async def wait_readable(self, fileobj):
+        # selectors.EVENT_READ == 1
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        # selectors.EVENT_WRITE == 2
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            # no sockets to watch, this is the old Scheduler8 behavior
+            if timeout:
+                time.sleep(timeout)
+            return
+        # ONE system call waits for all sockets at once, but never past the next timer
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            # stop watching events that nobody is waiting for
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        while self.ready or self.sleeping or self.selector.get_map():
+            if self.ready:
+                timeout = 0  # somebody can run right now, just peek at the sockets
+            elif self.sleeping:
+                timeout = max(0, self.sleeping[0][0] - time.time())
+            else:
+                timeout = None  # only sockets left, wait as long as it takes
+            self._poll(timeout)
+
+            if self.sleeping and self.sleeping[0][0] <= time.time():
+                _, _, coro = heapq.heappop(self.sleeping)
+                self.ready.append(coro)
+
+            # run every task that is ready right now, then go back to the selector
+            # tasks added during this loop wait for the next round
+            for _ in range(len(self.ready)):
+                self.current = self.ready.popleft()
+                try:
+                    self.current.send(None)
+                    if self.current:
+                        self.ready.append(self.current)
+                except StopIteration:
+                    # this task is finished
+                    pass
+
+
+sched = Scheduler11()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# a tiny echo server on one end of a socket pair
+# no threads! the server "blocks" on wait_readable while countdown keeps running
+async def echo(sock):
+    while True:
+        await sched.wait_readable(sock)
+        data = sock.recv(1000)
+        if not data:
+            break
+        await sched.wait_writable(sock)
+        sock.send(data.upper())
+    print("echo done")
+    sock.close()
+
+
+async def client(sock, n):
+    for x in range(n):
+        msg = ("hello %d" % x).encode()
+        await sched.wait_writable(sock)
+        sock.send(msg)
+        await sched.wait_readable(sock)
+        print("client got", sock.recv(1000))
+        await sched.sleep(0.5)
+    sock.close()
+
+
+async def countdown(n: int) -> None:
+    x = n
+    while x >= 0:
+        print("down", x)
+        await sched.sleep(1)
+        x -= 1
+
+
+server_sock, client_sock = socket.socketpair()
+server_sock.setblocking(False)
+client_sock.setblocking(False)
+sched.new_task(echo(server_sock))
+sched.new_task(client(client_sock, 5))
+sched.new_task(countdown(3))
+sched.run()
@@ -0,0 +1,227 @@
+# changes: wake EVERY expired sleeper at once and use a monotonic clock
+#
+# problem 1: Scheduler8.run pops exactly one sleeper per loop, and only when nobody else is ready
+# 100k tasks that all wake at the same instant need 100k trips around the loop
+# (plus one useless time.time() and time.sleep(0) for each of them)
+#
+# problem 2: time.time() is the wall clock, NTP or a user can move it at any moment
+# jump forward: every timer fires at once. jump backward: every timer stalls
+# time.monotonic() only ever moves forward, which is all a scheduler needs
+import heapq
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class Scheduler12:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    async def sleep(self, delay):
+        deadline = time.monotonic() + delay
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (deadline, self.sequence, self.current))
+        self.current = None  # disappear
+        await switch()  # go to next task
+
+    # -------------- same Scheduler11 code as in async11
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler11 code as in async11
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or sleeping or self.selector.get_map():
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            # read the clock ONCE and move every sleeper that is due into the ready queue
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                ready.append(heapq.heappop(sleeping)[2])
+
+            for _ in range(len(ready)):
+                self.current = ready.popleft()
+                try:
+                    self.current.send(None)
+                    if self.current:
+                        ready.append(self.current)
+                except StopIteration:
+                    pass
+
+
+sched = Scheduler12()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler8 code as in async 8 (only used for the benchmark below)
+
+
+class Scheduler8:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    async def sleep(self, delay):
+        deadline = time.time() + delay
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (deadline, self.sequence, self.current))
+        self.current = None
+        await switch()
+
+    def run(self):
+        while self.ready or self.sleeping:
+            if not self.ready:
+                deadline, _, coro = heapq.heappop(self.sleeping)
+                delta = deadline - time.time()
+                if delta > 0:
+                    time.sleep(delta)
+                self.ready.append(coro)
+            self.current = self.ready.popleft()
+            try:
+                self.current.send(None)
+                if self.current:
+                    self.ready.append(self.current)
+            except StopIteration:
+                pass
+
+
+# -------------- same Scheduler8 code as in async 8
+
+
+# timer storm: every task goes to sleep at the same time and wants to wake at the same deadline
+# "lateness" is how long after its deadline each task actually got to run again
+async def sleeper(scheduler, clock, delay, lateness):
+    deadline = clock() + delay
+    await scheduler.sleep(delay)
+    lateness.append(clock() - deadline)
+
+
+def timer_storm(scheduler, clock, ntasks, delay=1.0):
+    lateness = []
+    for _ in range(ntasks):
+        scheduler.new_task(sleeper(scheduler, clock, delay, lateness))
+    start = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - start
+    lateness.sort()
+    print(
+        "%-12s %7d tasks  total %.3fs  lateness p50 %.1fms  p99 %.1fms  max %.1fms"
+        % (
+            type(scheduler).__name__,
+            ntasks,
+            elapsed,
+            lateness[len(lateness) // 2] * 1000,
+            lateness[len(lateness) * 99 // 100] * 1000,
+            lateness[-1] * 1000,
+        )
+    )
+
+
+for ntasks in (1000, 10000, 100000):
+    timer_storm(Scheduler8(), time.time, ntasks)
+    timer_storm(Scheduler12(), time.monotonic, ntasks)
+
+
+# the async11 demo still works unchanged
+async def echo(sock):
+    while True:
+        await sched.wait_readable(sock)
+        data = sock.recv(1000)
+        if not data:
+            break
+        await sched.wait_writable(sock)
+        sock.send(data.upper())
+    print("echo done")
+    sock.close()
+
+
+async def client(sock, n):
+    for x in range(n):
+        msg = ("hello %d" % x).encode()
+        await sched.wait_writable(sock)
+        sock.send(msg)
+        await sched.wait_readable(sock)
+        print("client got", sock.recv(1000))
+        await sched.sleep(0.5)
+    sock.close()
+
+
+server_sock, client_sock = socket.socketpair()
+server_sock.setblocking(False)
+client_sock.setblocking(False)
+sched.new_task(echo(server_sock))
+sched.new_task(client(client_sock, 3))
+sched.run()
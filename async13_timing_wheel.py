@@ -0,0 +1,299 @@
+# changes: the sleeping heap becomes a pluggable "timer backend", and we add a hierarchical timing wheel
+#
+# heapq costs O(log n) for every push and pop, and every timer allocates a (deadline, sequence, task) tuple
+# that's fine for a few thousand sleepers, but some programs have MILLIONS of short timeouts
+#
+# a timing wheel is a clock face: one bucket (list) per tick of e.g. 1 millisecond
+# adding a timer is just `bucket.append(task)`, and expiring a tick empties one bucket: both O(1)
+# one wheel of 256 buckets only reaches 256ms into the future, so we stack wheels like clock hands:
+#   wheel 0: one bucket per tick      (0 - 256 ticks away)
+#   wheel 1: one bucket per 256 ticks (up to 65536 ticks away)
+#   wheel 2: one bucket per 65536 ticks, ...
+# when the lower hand completes a full turn, the next bucket of the wheel above is "cascaded":
+# its timers are re-inserted, and since they are now closer, they fall into a lower wheel
+import heapq
+import random
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class HeapTimers:
+    # the async3/async12 heap, wrapped up so that the scheduler doesn't care which backend it uses
+    def __init__(self):
+        self.heap = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, deadline, item):
+        self.sequence += 1
+        heapq.heappush(self.heap, (deadline, self.sequence, item))
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now, ready):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            ready.append(heapq.heappop(heap)[2])
+
+
+class TimingWheel:
+    def __init__(self, resolution=0.001, bits=8, levels=4):
+        self.resolution = resolution  # seconds per tick
+        self.bits = bits  # 2**bits buckets per wheel
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.max_delta = (1 << (bits * levels)) - 1  # ~49 days with the defaults
+        self.wheels = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.counts = [0] * levels
+        self.tick = int(time.monotonic() / resolution)  # the next tick that has not expired yet
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def push(self, deadline, item):
+        # round UP: a timer may fire up to one tick late, but never early
+        self._insert(int(-(-deadline // self.resolution)), item)
+
+    def _insert(self, when, item):
+        delta = when - self.tick
+        if delta < 1 << self.bits:
+            # the common case: no tuple, the bucket only stores the task itself
+            self.wheels[0][max(when, self.tick) & self.mask].append(item)
+            self.counts[0] += 1
+            return
+        # timers too far away wait in the last bucket and get re-inserted when it cascades
+        delta = min(delta, self.max_delta)
+        level = (delta.bit_length() - 1) // self.bits
+        index = ((self.tick + delta) >> (self.bits * level)) & self.mask
+        self.wheels[level][index].append((when, item))
+        self.counts[level] += 1
+
+    def _cascade(self, tick):
+        for level in range(1, self.levels):
+            index = (tick >> (self.bits * level)) & self.mask
+            bucket = self.wheels[level][index]
+            if bucket:
+                self.wheels[level][index] = []
+                self.counts[level] -= len(bucket)
+                for when, item in bucket:
+                    self._insert(when, item)
+            if index:
+                # the wheel above only turns when this one wrapped around to 0
+                break
+
+    def next_deadline(self):
+        if not len(self):
+            return None
+        tick = self.tick
+        if self.counts[0] == len(self):
+            end = tick + self.mask + 1
+        elif tick & self.mask:
+            # only look until the next cascade, which may bring earlier timers down to wheel 0
+            end = (tick | self.mask) + 1
+        else:
+            return tick * self.resolution  # a cascade is due right now
+        wheel = self.wheels[0]
+        for when in range(tick, end):
+            if wheel[when & self.mask]:
+                return when * self.resolution
+        return end * self.resolution
+
+    def pop_due(self, now, ready):
+        now_tick = int(now / self.resolution)
+        wheel = self.wheels[0]
+        mask = self.mask
+        while self.tick <= now_tick:
+            tick = self.tick
+            if not tick & mask:
+                self._cascade(tick)
+            bucket = wheel[tick & mask]
+            if bucket:
+                ready.extend(bucket)
+                self.counts[0] -= len(bucket)
+                bucket.clear()
+            if self.counts[0]:
+                self.tick = tick + 1
+            elif len(self):
+                # wheel 0 is empty: jump straight to the next cascade
+                self.tick = min(now_tick + 1, (tick | mask) + 1)
+            else:
+                # no timers at all, nothing to catch up on
+                self.tick = now_tick + 1
+
+
+class Scheduler13:
+    def __init__(self, timers=None):
+        self.ready = deque()
+        self.current = None
+        # any object with push(), pop_due(), next_deadline() and len() will do
+        self.timers = HeapTimers() if timers is None else timers
+        self.selector = selectors.DefaultSelector()
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    async def sleep(self, delay):
+        self.timers.push(time.monotonic() + delay, self.current)
+        self.current = None  # disappear
+        await switch()  # go to next task
+
+    # -------------- same Scheduler12 code as in async12
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler12 code as in async12
+
+    def run(self):
+        ready = self.ready
+        timers = self.timers
+        while ready or len(timers) or self.selector.get_map():
+            if ready:
+                timeout = 0
+            else:
+                deadline = timers.next_deadline()
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            self._poll(timeout)
+
+            timers.pop_due(time.monotonic(), ready)
+
+            for _ in range(len(ready)):
+                self.current = ready.popleft()
+                try:
+                    self.current.send(None)
+                    if self.current:
+                        ready.append(self.current)
+                except StopIteration:
+                    pass
+
+
+sched = Scheduler13(timers=TimingWheel())
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# benchmark: insert n timers spread over the next 10 seconds, then expire all of them at once
+# we pass a fake "now" to pop_due() so that we don't actually have to wait 10 seconds
+def bench_timers(make_timers, n):
+    rng = random.Random(42)
+    base = time.monotonic()
+    deadlines = [base + rng.uniform(0, 10) for _ in range(n)]
+    timers = make_timers()
+    start = time.perf_counter()
+    for deadline in deadlines:
+        timers.push(deadline, None)
+    inserted = time.perf_counter()
+    expired = []
+    timers.pop_due(base + 11, expired)
+    done = time.perf_counter()
+    assert len(expired) == n and not len(timers)
+    print(
+        "%-12s %8d timers  insert %5.0fns/timer  expire %5.0fns/timer"
+        % (
+            make_timers.__name__,
+            n,
+            (inserted - start) / n * 1e9,
+            (done - inserted) / n * 1e9,
+        )
+    )
+
+
+for n in (10**4, 10**5, 10**6):
+    bench_timers(HeapTimers, n)
+    bench_timers(TimingWheel, n)
+
+
+# the async11 demo, this time on top of the timing wheel
+async def echo(sock):
+    while True:
+        await sched.wait_readable(sock)
+        data = sock.recv(1000)
+        if not data:
+            break
+        await sched.wait_writable(sock)
+        sock.send(data.upper())
+    print("echo done")
+    sock.close()
+
+
+async def client(sock, n):
+    for x in range(n):
+        msg = ("hello %d" % x).encode()
+        await sched.wait_writable(sock)
+        sock.send(msg)
+        await sched.wait_readable(sock)
+        print("client got", sock.recv(1000))
+        await sched.sleep(0.5)
+    sock.close()
+
+
+async def countdown(n: int) -> None:
+    x = n
+    while x >= 0:
+        print("down", x)
+        await sched.sleep(1)
+        x -= 1
+
+
+server_sock, client_sock = socket.socketpair()
+server_sock.setblocking(False)
+client_sock.setblocking(False)
+sched.new_task(echo(server_sock))
+sched.new_task(client(client_sock, 3))
+sched.new_task(countdown(2))
+sched.run()
@@ -0,0 +1,230 @@
+# changes: call_later returns a TimerHandle that can be cancelled
+#
+# most timers are timeouts: "give up if the answer doesn't arrive in 30 seconds"
+# and most answers DO arrive in time, so most timeouts should never fire
+# before this change there was no way to take a timer back, it just sat in the heap until its deadline
+#
+# removing an entry from the middle of a heap is O(n), so we don't: cancel() only flips a flag
+# and the run loop throws cancelled entries away when they reach the top of the heap ("lazy deletion")
+# if MOST of the heap is cancelled garbage, we rebuild it in place: O(n), but only once in a while
+#
+# (back to the async12 heap, the async13 timing wheel stays an experiment)
+import heapq
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class TimerHandle:
+    # __slots__: no per-object __dict__, handles are small and cheap to create
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler  # None once the timer fired
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler14:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        # rebuild the heap once this fraction of it is cancelled timers
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        # a sleeping task is just a timer that puts the task back into the ready queue
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None  # disappear
+        await switch()  # go to next task
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            # [:] keeps the same list object, run() holds a reference to it
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    # -------------- same Scheduler12 code as in async12
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler12 code as in async12
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        # cancelled timers don't keep the scheduler alive
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            # don't wake up for a timer that was cancelled
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                self.current = ready.popleft()
+                try:
+                    self.current.send(None)
+                    if self.current:
+                        ready.append(self.current)
+                except StopIteration:
+                    pass
+
+
+sched = Scheduler14()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# benchmark: a request handler arms a 30 second timeout for every request
+# 99% of requests answer in time and cancel their timeout
+def bench_timeouts(compact_ratio, n):
+    scheduler = Scheduler14(compact_ratio=compact_ratio)
+    start = time.perf_counter()
+    for x in range(n):
+        handle = scheduler.call_later(30, print, "request", x, "timed out")
+        if x % 100:
+            handle.cancel()
+    elapsed = time.perf_counter() - start
+    print(
+        "compact_ratio=%-5s %8d timeouts  %5.0fns/timeout  heap size %8d  (%d still pending)"
+        % (
+            compact_ratio,
+            n,
+            elapsed / n * 1e9,
+            len(scheduler.sleeping),
+            len(scheduler.sleeping) - scheduler.cancelled_timers,
+        )
+    )
+
+
+for n in (10**4, 10**5, 10**6):
+    bench_timeouts(None, n)
+    bench_timeouts(0.5, n)
+
+
+async def fetch(sock, timeout):
+    # arm a watchdog, then do the real work
+    watchdog = sched.call_later(timeout, print, "fetch timed out after", timeout, "seconds")
+    await sched.wait_writable(sock)
+    sock.send(b"ping")
+    await sched.wait_readable(sock)
+    print("fetch got", sock.recv(1000))
+    # the answer arrived in time, the scheduler no longer waits for the watchdog
+    watchdog.cancel()
+    sock.close()
+
+
+async def slow_server(sock, delay):
+    await sched.wait_readable(sock)
+    data = sock.recv(1000)
+    await sched.sleep(delay)
+    await sched.wait_writable(sock)
+    sock.send(data.upper())
+    sock.close()
+
+
+server_sock, client_sock = socket.socketpair()
+server_sock.setblocking(False)
+client_sock.setblocking(False)
+sched.new_task(slow_server(server_sock, 0.5))
+sched.new_task(fetch(client_sock, 10))
+start = time.monotonic()
+sched.run()
+print("done after %.1f seconds, not 10" % (time.monotonic() - start))
@@ -0,0 +1,275 @@
+# changes: new_task wraps every coroutine in a Task object
+#
+# problem 1: the return value of a coroutine ends up in StopIteration.value, and the run loop ignored it
+# problem 2: an exception inside ONE coroutine crashed run() and with it EVERY other task
+# problem 3: there was no way for one task to wait until another task is finished
+#
+# a Task remembers the result (or the exception) of its coroutine, and it is awaitable:
+#   result = await sched.new_task(child())
+# a task that awaits an unfinished task disappears from the ready queue and is stored in task.waiters
+# (the same trick AsyncQueue.get uses), so waiting costs nothing until the child finishes
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+# -------------- same TimerHandle code as in async14
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+# -------------- same TimerHandle code as in async14
+
+
+class Scheduler15:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()  # Tasks, not coroutines
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    # -------------- same Scheduler14 code as in async14
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler14 code as in async14
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    # the coroutine returned: its return value is e.value
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    # the coroutine crashed: only this task dies, the others keep running
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+
+sched = Scheduler15()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+async def square(x):
+    if x % 2:
+        await switch()  # half of the subtasks actually suspend
+    return x * x
+
+
+async def fan_in(n):
+    # spawn n subtasks, then wait for each of them
+    start = time.perf_counter()
+    tasks = [sched.new_task(square(x)) for x in range(n)]
+    total = 0
+    for task in tasks:
+        total += await task
+    elapsed = time.perf_counter() - start
+    print("fan-in of %6d subtasks: sum %d in %.3fs (%.0fns/subtask)" % (n, total, elapsed, elapsed / n * 1e9))
+    return total
+
+
+async def crash(delay):
+    await sched.sleep(delay)
+    raise ValueError("crashed after %s seconds" % delay)
+
+
+async def supervisor():
+    try:
+        await sched.new_task(crash(0.1))
+    except ValueError as e:
+        print("supervisor caught:", e)
+
+
+async def countdown(n: int) -> None:
+    x = n
+    while x >= 0:
+        print("down", x)
+        await sched.sleep(0.2)
+        x -= 1
+    return "liftoff"
+
+
+async def main():
+    launch = sched.new_task(countdown(3))
+    sched.new_task(supervisor())
+    # nobody awaits this one: its exception gets reported, but the other tasks don't notice
+    sched.new_task(crash(0.3))
+    for n in (1000, 10000, 50000):
+        await sched.new_task(fan_in(n))
+    print("countdown returned", await launch)
+
+
+sched.new_task(main())
+sched.run()
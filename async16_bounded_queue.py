@@ -0,0 +1,325 @@
+# changes: AsyncQueue(maxsize) and `await q.put(item)` for backpressure
+#
+# the async10 AsyncQueue is unbounded: put() never waits
+# a producer that is faster than its consumers fills up memory until the program dies
+# with a maxsize, a producer that finds the queue full disappears into self.putters
+# (exactly like a getter that finds the queue empty disappears into self.waiting)
+# and every get() that makes room wakes up one putter
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler15 code as in async15
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler15:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()  # Tasks, not coroutines
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    # the coroutine returned: its return value is e.value
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    # the coroutine crashed: only this task dies, the others keep running
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+
+sched = Scheduler15()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler15 code as in async15
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize  # 0 means no limit, like queue.Queue
+        self.waiting = deque()  # getters waiting for an item
+        self.putters = deque()  # putters waiting for a free spot
+        self._closed = False
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        # wake up EVERYBODY: getters drain what is left and then see QueueClosed, putters see it right away
+        sched.ready.extend(self.waiting)
+        self.waiting.clear()
+        sched.ready.extend(self.putters)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+        if self.waiting:
+            sched.ready.append(self.waiting.popleft())
+
+    async def put(self, item):
+        while self.full() and not self._closed:
+            # no room: disappear until a getter makes some
+            self.putters.append(sched.current)
+            sched.current = None
+            await switch()
+        self.put_nowait(item)
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current = None
+            await switch()
+        item = self.items.popleft()
+        if self.putters:
+            # we just made room for one more item
+            sched.ready.append(self.putters.popleft())
+        return item
+
+
+async def producer(q, count):
+    for n in range(count):
+        # a fast producer: no sleep, but it still can't get more than maxsize items ahead
+        await q.put(n)
+        print("produced", n, "queue size", q.qsize())
+    print("producer done")
+    q.close()
+
+
+async def consumer(q, name):
+    try:
+        while True:
+            item = await q.get()
+            print(name, "consuming", item)
+            await sched.sleep(0.1)  # a slow consumer
+    except QueueClosed:
+        print(name, "done")
+
+
+async def stuck_putter(q):
+    try:
+        await q.put("never fits")
+    except QueueClosed:
+        print("putter woken up by close()")
+
+
+async def main():
+    q = AsyncQueue(maxsize=3)
+    sched.new_task(consumer(q, "consumer 1"))
+    sched.new_task(consumer(q, "consumer 2"))
+    await sched.new_task(producer(q, 10))
+
+    # close() wakes up parked putters too
+    full = AsyncQueue(maxsize=1)
+    full.put_nowait("the only spot")
+    putter = sched.new_task(stuck_putter(full))
+    await sched.sleep(0.1)
+    print("full:", full.full(), "qsize:", full.qsize())
+    full.close()
+    await putter
+    print("left in the closed queue:", await full.get())
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,416 @@
+# changes: AsyncQueue.get_many() and AsyncQueue.put_many() move items in bulk
+#
+# every item that goes through the async16 queue costs one put(), one get()
+# and usually one trip of the consumer through sched.ready
+# for lots of tiny messages, the task switches cost more than the actual work
+#
+# batching: a consumer asks for "up to 100 items", a producer hands over a whole list at once
+# waiters are woken once per batch instead of once per item
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler15 code as in async15
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler15:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()  # Tasks, not coroutines
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    # the coroutine returned: its return value is e.value
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    # the coroutine crashed: only this task dies, the others keep running
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+
+sched = Scheduler15()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler15 code as in async15
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    # -------------- same AsyncQueue code as in async16
+
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.waiting = deque()
+        self.putters = deque()
+        self._closed = False
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        sched.ready.extend(self.waiting)
+        self.waiting.clear()
+        sched.ready.extend(self.putters)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+        if self.waiting:
+            sched.ready.append(self.waiting.popleft())
+
+    async def put(self, item):
+        while self.full() and not self._closed:
+            self.putters.append(sched.current)
+            sched.current = None
+            await switch()
+        self.put_nowait(item)
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current = None
+            await switch()
+        item = self.items.popleft()
+        if self.putters:
+            sched.ready.append(self.putters.popleft())
+        return item
+
+    # -------------- same AsyncQueue code as in async16
+
+    def _wake(self, waiters, n):
+        # wake up to n waiters in one go
+        for _ in range(min(n, len(waiters))):
+            sched.ready.append(waiters.popleft())
+
+    async def put_many(self, items):
+        items = list(items)
+        start = 0
+        while start < len(items):
+            while self.full() and not self._closed:
+                self.putters.append(sched.current)
+                sched.current = None
+                await switch()
+            if self._closed:
+                raise QueueClosed()
+            # put as many items as there is room for, then wait for more room
+            if self.maxsize > 0:
+                end = start + self.maxsize - len(self.items)
+            else:
+                end = len(items)
+            batch = items[start:end]
+            self.items.extend(batch)
+            self._wake(self.waiting, len(batch))
+            start += len(batch)
+
+    def _get_timeout(self, task):
+        try:
+            self.waiting.remove(task)
+        except ValueError:
+            # a put() woke this task up before the timer fired
+            return
+        sched.ready.append(task)
+
+    async def get_many(self, max_items, timeout=None):
+        # wait for at least one item, then return up to max_items of them
+        # with a timeout, return an empty list if nothing arrived in time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            handle = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                handle = sched.call_later(remaining, self._get_timeout, sched.current)
+            self.waiting.append(sched.current)
+            sched.current = None
+            await switch()
+            if handle is not None:
+                handle.cancel()
+        items = self.items
+        batch = [items.popleft() for _ in range(min(max_items, len(items)))]
+        self._wake(self.putters, len(batch))
+        return batch
+
+
+# -------------- the async10 producer/consumer, one item at a time
+
+
+async def producer(q, count):
+    for n in range(count):
+        await q.put(n)
+    q.close()
+
+
+async def consumer(q, totals):
+    try:
+        while True:
+            item = await q.get()
+            totals.append(item)
+    except QueueClosed:
+        pass
+
+
+# -------------- the same thing, one batch at a time
+
+
+async def batch_producer(q, count, batch_size):
+    for start in range(0, count, batch_size):
+        await q.put_many(range(start, min(start + batch_size, count)))
+    q.close()
+
+
+async def batch_consumer(q, totals, batch_size):
+    try:
+        while True:
+            totals.extend(await q.get_many(batch_size))
+    except QueueClosed:
+        pass
+
+
+def bench_queue(name, count, make_producer, make_consumer):
+    q = AsyncQueue(maxsize=1000)
+    totals = []
+    sched.new_task(make_producer(q, count))
+    sched.new_task(make_consumer(q, totals))
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    assert totals == list(range(count))
+    print("%-26s %7d items in %.3fs  %9.0f items/s" % (name, count, elapsed, count / elapsed))
+
+
+count = 200000
+bench_queue("put()/get()", count, producer, consumer)
+for batch_size in (10, 100, 1000):
+    bench_queue(
+        "put_many()/get_many(%d)" % batch_size,
+        count,
+        lambda q, n: batch_producer(q, n, batch_size),
+        lambda q, totals: batch_consumer(q, totals, batch_size),
+    )
+
+
+async def slow_producer(q):
+    for n in range(3):
+        await sched.sleep(0.3)
+        await q.put_many([n] * (n + 1))
+    q.close()
+
+
+async def impatient_consumer(q):
+    try:
+        while True:
+            batch = await q.get_many(10, timeout=0.2)
+            print("got", batch if batch else "nothing in 0.2s")
+    except QueueClosed:
+        print("consumer done")
+
+
+q = AsyncQueue()
+sched.new_task(slow_producer(q))
+sched.new_task(impatient_consumer(q))
+sched.run()
@@ -0,0 +1,330 @@
+# changes: `await sched.run_in_thread(func, *args)` for blocking calls
+#
+# remember async7? a blocking call like time.sleep(1) inside ONE coroutine freezes EVERY task
+# some calls have no async version: old libraries, DNS lookups, file I/O, ...
+# solution: hand the blocking call to a worker thread and let the task disappear until it's done
+#
+# how does the scheduler find out that a thread finished, if it is stuck inside selector.select()?
+# the "self-pipe trick": the scheduler watches one end of a socket pair like any other socket
+# and a finished thread writes one byte into the other end, which wakes up select() right away
+# no polling, no spinning, no extra timers
+import heapq
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler18:
+    def __init__(self, compact_ratio=0.5, max_threads=8):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        # worker threads are only started the first time somebody needs one
+        self.max_threads = max_threads
+        self.executor = None
+        self.pending_jobs = 0  # tasks waiting for a thread, they keep run() alive
+        self.completed = deque()  # filled by worker threads, deque.append is thread-safe
+        # the self-pipe: a thread writes to _wake_w, the selector watches _wake_r
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def _wakeup(self):
+        # may be called from ANY thread
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # the pipe is full of wake up bytes already, the scheduler will wake up anyway
+            pass
+
+    def _job_done(self, task):
+        # runs in the worker thread
+        self.completed.append(task)
+        self._wakeup()
+
+    async def run_in_thread(self, func, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        task = self.current
+        future = self.executor.submit(func, *args)
+        self.pending_jobs += 1
+        future.add_done_callback(lambda _: self._job_done(task))
+        self.current = None  # disappear until the thread is done
+        await switch()
+        # the return value, or the exception raised inside the thread
+        return future.result()
+
+    # -------------- same Scheduler15 code as in async15
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    # -------------- same Scheduler15 code as in async15
+
+    def _poll(self, timeout):
+        # the self-pipe is always registered, so there's always something to select() on
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if waiters is None:
+                # somebody wrote to the self-pipe: throw the bytes away, self.completed has the news
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        completed = self.completed
+        # len(get_map()) > 1: some socket besides the self-pipe is being watched
+        while (
+            ready
+            or len(sleeping) > self.cancelled_timers
+            or len(self.selector.get_map()) > 1
+            or self.pending_jobs
+        ):
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready or completed:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            while completed:
+                ready.append(completed.popleft())
+                self.pending_jobs -= 1
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+    def close(self):
+        # the worker threads and the self-pipe outlive run(): give them back once the program is done
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.selector.unregister(self._wake_r)
+        self._wake_r.close()
+        self._wake_w.close()
+        self.selector.close()
+
+
+sched = Scheduler18()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+def blocking_lookup(name):
+    # pretend this is a slow library call that has no async version
+    time.sleep(0.5)
+    if name == "nowhere":
+        raise LookupError("no such host: %s" % name)
+    return "%s -> 10.0.0.%d (%s)" % (name, len(name), threading.current_thread().name)
+
+
+# the async7 countdown and countup, but the blocking time.sleep runs in a thread
+async def countdown(n: int) -> None:
+    x = n
+    while x >= 0:
+        print("down", x)
+        await sched.run_in_thread(time.sleep, 1)
+        x -= 1
+
+
+async def countup(n: int) -> None:
+    x = 0
+    while x <= n:
+        print("up", x)
+        await sched.run_in_thread(time.sleep, 0.5)
+        x += 1
+
+
+async def lookup(name):
+    try:
+        print(await sched.run_in_thread(blocking_lookup, name))
+    except LookupError as e:
+        print("lookup failed:", e)
+
+
+async def main():
+    start = time.monotonic()
+    countdown_task = sched.new_task(countdown(2))
+    countup_task = sched.new_task(countup(5))
+    # 8 blocking lookups of 0.5 seconds each share 8 threads with the counters: ~1 second, not 4
+    lookups = [sched.new_task(lookup(name)) for name in ("python.org", "example.com", "nowhere", "localhost")]
+    lookups += [sched.new_task(lookup("host%d" % x)) for x in range(4)]
+    for task in lookups:
+        await task
+    print("8 lookups done after %.1f seconds" % (time.monotonic() - start))
+    await countdown_task
+    await countup_task
+    print("all done after %.1f seconds" % (time.monotonic() - start))
+
+
+sched.new_task(main())
+sched.run()
+sched.close()
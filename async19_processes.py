@@ -0,0 +1,380 @@
+# changes: `await sched.run_in_process(func, *args)` for CPU-bound work
+#
+# run_in_thread helps with calls that WAIT (sleep, network, disk)
+# but it doesn't help with calls that COMPUTE: the GIL only lets one thread run Python code at a time
+# so a long computation in a thread still competes with the scheduler for the same CPU core
+#
+# worker processes have their own interpreter and their own GIL: one process per core
+# ProcessPoolExecutor hands us a Future just like ThreadPoolExecutor,
+# so results come back through the exact same self-pipe wakeup as async18
+import heapq
+import os
+import selectors
+import socket
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _run_chunk(func, chunk):
+    # runs inside a worker process: one round trip for a whole chunk of items
+    return [func(item) for item in chunk]
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler19:
+    def __init__(self, compact_ratio=0.5, max_threads=8, max_processes=None):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        # worker threads are only started the first time somebody needs one
+        self.max_threads = max_threads
+        self.executor = None
+        # same for worker processes, max_processes=None means one per CPU core
+        self.max_processes = max_processes
+        self.process_pool = None
+        self.pending_jobs = 0  # tasks waiting for a thread or a process, they keep run() alive
+        self.completed = deque()  # filled by worker threads, deque.append is thread-safe
+        # the self-pipe: a thread writes to _wake_w, the selector watches _wake_r
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def _wakeup(self):
+        # may be called from ANY thread
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # the pipe is full of wake up bytes already, the scheduler will wake up anyway
+            pass
+
+    def _job_done(self, task):
+        # runs in a worker thread, or in the thread that collects results from the worker processes
+        self.completed.append(task)
+        self._wakeup()
+
+    async def _run_in_executor(self, executor, func, *args):
+        task = self.current
+        future = executor.submit(func, *args)
+        self.pending_jobs += 1
+        # for both pools, the callback runs in a background thread once the result is back
+        future.add_done_callback(lambda _: self._job_done(task))
+        self.current = None  # disappear until the job is done
+        await switch()
+        return future.result()
+
+    async def run_in_thread(self, func, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        return await self._run_in_executor(self.executor, func, *args)
+
+    async def run_in_process(self, func, *args):
+        # func, args and the result travel between processes, so they must be picklable
+        if self.process_pool is None:
+            # starting processes is slow: do it once, then reuse them for every call
+            self.process_pool = ProcessPoolExecutor(max_workers=self.max_processes)
+        return await self._run_in_executor(self.process_pool, func, *args)
+
+    async def map_in_process(self, func, items, chunksize=1000):
+        # one job per item would spend more time pickling than computing
+        # so we send the items to the worker processes in chunks
+        items = list(items)
+        chunks = [items[start : start + chunksize] for start in range(0, len(items), chunksize)]
+        tasks = [self.new_task(self.run_in_process(_run_chunk, func, chunk)) for chunk in chunks]
+        results = []
+        for task in tasks:
+            results.extend(await task)
+        return results
+
+    # -------------- same Scheduler18 code as in async18
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    # -------------- same Scheduler18 code as in async18
+
+    def _poll(self, timeout):
+        # the self-pipe is always registered, so there's always something to select() on
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if waiters is None:
+                # somebody wrote to the self-pipe: throw the bytes away, self.completed has the news
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        completed = self.completed
+        # len(get_map()) > 1: some socket besides the self-pipe is being watched
+        while (
+            ready
+            or len(sleeping) > self.cancelled_timers
+            or len(self.selector.get_map()) > 1
+            or self.pending_jobs
+        ):
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready or completed:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            while completed:
+                ready.append(completed.popleft())
+                self.pending_jobs -= 1
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+    def close(self):
+        # worker threads, worker processes and the self-pipe outlive run(): give them back at the end
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        self.selector.unregister(self._wake_r)
+        self._wake_r.close()
+        self._wake_w.close()
+        self.selector.close()
+
+
+sched = Scheduler19()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+def count_primes(limit):
+    # deliberately slow, pure Python, CPU-bound work
+    count = 0
+    for n in range(2, limit):
+        for d in range(2, int(n**0.5) + 1):
+            if n % d == 0:
+                break
+        else:
+            count += 1
+    return count
+
+
+async def ticker(stop):
+    # keeps ticking while the heavy lifting happens in other processes
+    ticks = 0
+    while not stop:
+        ticks += 1
+        await sched.sleep(0.1)
+    print("the scheduler stayed responsive: %d ticks" % ticks)
+
+
+async def main():
+    stop = []
+    sched.new_task(ticker(stop))
+    print("primes below 20000:", await sched.run_in_process(count_primes, 20000))
+    results = await sched.map_in_process(count_primes, range(0, 3000, 3), chunksize=100)
+    print("map_in_process over %d items, last result %d" % (len(results), results[-1]))
+    stop.append(True)
+
+
+def bench_processes(workers, items, chunksize):
+    # Task and the module-level helpers (ticker, main, ...) only know the global `sched`:
+    # swap its process pool instead of making a new scheduler
+    if sched.process_pool is not None:
+        sched.process_pool.shutdown()
+    sched.process_pool = ProcessPoolExecutor(max_workers=workers)
+
+    async def work():
+        return await sched.map_in_process(count_primes, items, chunksize=chunksize)
+
+    task = sched.new_task(work())
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    return task.result, elapsed
+
+
+# the worker processes may import this file again (that's how it works on macOS and Windows)
+# so this time the demo must only run when the file is executed directly
+if __name__ == "__main__":
+    sched.new_task(main())
+    sched.run()
+
+    # benchmark: the same batch of CPU-bound work with more and more worker processes
+    items = [20000] * 32
+    start = time.perf_counter()
+    expected = [count_primes(n) for n in items]
+    baseline = time.perf_counter() - start
+    print("%-20s %.2fs" % ("scheduler thread", baseline))
+    cores = os.cpu_count() or 1
+    workers = 1
+    while True:
+        result, elapsed = bench_processes(workers, items, chunksize=2)
+        assert result == expected
+        print("%-20s %.2fs  speedup %.1fx" % ("%d processes" % workers, elapsed, baseline / elapsed))
+        if workers >= cores:
+            break
+        workers = min(workers * 2, cores)
+    sched.close()
@@ -0,0 +1,439 @@
+# changes: run one scheduler per CPU core, and let idle schedulers steal work from busy ones
+#
+# every scheduler so far is ONE ready queue on ONE thread: one CPU core, no matter how many we have
+# new idea: N workers, each one a complete scheduler with its own ready queue, timers and sockets
+#   - free-threaded Python (no GIL): the workers are threads
+#   - regular Python: the GIL would run one thread at a time, so the workers are processes
+#
+# new jobs go into a worker's "inbox". a worker that has nothing to do looks into its own inbox,
+# and if that's empty it STEALS the oldest job from another worker's inbox ("work stealing")
+# only jobs that haven't started yet can move: a running task stays with its worker's timers and sockets
+#
+# a job has to travel to another process, so it is a picklable coroutine FUNCTION plus arguments:
+#   multi.new_task(handle_request, 42)   instead of   sched.new_task(handle_request(42))
+# and since there is no single `sched` anymore, tasks ask for "the scheduler running on my thread"
+import heapq
+import inspect
+import multiprocessing
+import os
+import queue
+import random
+import selectors
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+# every worker thread (or process) remembers its own scheduler here
+_local = threading.local()
+
+
+def get_scheduler():
+    return _local.scheduler
+
+
+async def sleep(delay):
+    await get_scheduler().sleep(delay)
+
+
+def spawn(func, *args):
+    # start a job that any worker may steal
+    get_scheduler().spawn(func, *args)
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+def free_threaded():
+    # sys._is_gil_enabled() only exists on Python 3.13+
+    return not getattr(sys, "_is_gil_enabled", lambda: True)()
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            sched = get_scheduler()  # the only change from async15
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    # -------------- same Task code as in async15
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+    # -------------- same Task code as in async15
+
+
+class TimerHandle:
+    # -------------- same TimerHandle code as in async14
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class ThreadCounter:
+    # looks like multiprocessing.Value("i"), for workers that are threads
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
+
+
+class Scheduler20:
+    # one worker: the async15 scheduler plus an inbox of jobs that other workers can steal
+    def __init__(self, index, inboxes, outstanding, results, threads, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        self.index = index
+        self.inboxes = inboxes  # threads: one deque per worker, processes: one multiprocessing.Queue
+        self.outstanding = outstanding  # jobs that were started anywhere and haven't finished yet
+        self.results = results
+        self.threads = threads
+        self.jobs_run = 0
+        self.jobs_stolen = 0
+
+    def new_task(self, coro):
+        # a local task: it will run on this worker and nowhere else
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def spawn(self, func, *args):
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        job = (None, func, args)
+        if self.threads:
+            self.inboxes[self.index].append(job)
+        else:
+            self.inboxes[self.index].put(job)
+
+    def _take_job(self):
+        # own inbox first. threads take the NEWEST job, its data is probably still in the CPU cache
+        inbox = self.inboxes[self.index]
+        try:
+            return inbox.pop() if self.threads else inbox.get_nowait()
+        except (IndexError, queue.Empty):
+            pass
+        # then steal the OLDEST job of a peer, starting at a random one so thieves spread out
+        count = len(self.inboxes)
+        start = random.randrange(count)
+        for offset in range(count):
+            peer = (start + offset) % count
+            if peer == self.index:
+                continue
+            try:
+                job = self.inboxes[peer].popleft() if self.threads else self.inboxes[peer].get_nowait()
+            except (IndexError, queue.Empty):
+                continue
+            self.jobs_stolen += 1
+            return job
+        return None
+
+    async def _run_job(self, job_id, coro):
+        try:
+            result = await coro
+        except Exception as e:
+            self.results.put(("error", job_id, e))
+        else:
+            if job_id is not None:
+                self.results.put(("result", job_id, result))
+        finally:
+            with self.outstanding.get_lock():
+                self.outstanding.value -= 1
+
+    def _start_job(self, job):
+        job_id, func, args = job
+        # threads may pass a coroutine object around, processes can only pass a function
+        coro = func if args is None else func(*args)
+        self.jobs_run += 1
+        self.new_task(self._run_job(job_id, coro))
+
+    # -------------- same Scheduler15 code as in async15
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler15 code as in async15
+
+    def run(self):
+        _local.scheduler = self
+        ready = self.ready
+        sleeping = self.sleeping
+        backoff = 0
+        while True:
+            if not ready:
+                job = self._take_job()
+                if job is not None:
+                    self._start_job(job)
+                    backoff = 0
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if not (ready or sleeping or self.selector.get_map()):
+                if not self.outstanding.value:
+                    break  # nothing here, nothing to steal, and nobody can create more work
+                # somebody else is still busy: back off a little before trying to steal again
+                backoff = min(max(backoff * 2, 0.00005), 0.005)
+                time.sleep(backoff)
+                continue
+            if ready:
+                timeout = 0
+            else:
+                # wake up now and then to look for work to steal while waiting for timers and sockets
+                timeout = 0.005
+                if sleeping:
+                    timeout = min(timeout, max(0, sleeping[0][0] - time.monotonic()))
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+        self.results.put(("stats", self.index, (self.jobs_run, self.jobs_stolen)))
+
+
+def _worker_main(index, inboxes, outstanding, results, threads):
+    Scheduler20(index, inboxes, outstanding, results, threads).run()
+
+
+class MultiScheduler:
+    def __init__(self, workers=None, threads=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = free_threaded() if threads is None else threads
+        if self.threads:
+            self.inboxes = [deque() for _ in range(self.workers)]
+            self.outstanding = ThreadCounter()
+            self.results = queue.Queue()
+        else:
+            self.inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+            self.outstanding = multiprocessing.Value("i", 0)
+            self.results = multiprocessing.Queue()
+        self.jobs = 0
+        self.stats = {}
+
+    def new_task(self, func, *args):
+        if inspect.iscoroutine(func):
+            if not self.threads:
+                func.close()
+                raise TypeError("worker processes need a coroutine function: new_task(func, *args)")
+            job = (self.jobs, func, None)
+        else:
+            job = (self.jobs, func, args)
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        # hand out the jobs round-robin, stealing evens out whatever imbalance is left
+        inbox = self.inboxes[self.jobs % self.workers]
+        if self.threads:
+            inbox.append(job)
+        else:
+            inbox.put(job)
+        self.jobs += 1
+        return job[0]
+
+    def run(self):
+        args = (self.inboxes, self.outstanding, self.results, self.threads)
+        runner_class = threading.Thread if self.threads else multiprocessing.Process
+        runners = [runner_class(target=_worker_main, args=(index,) + args) for index in range(self.workers)]
+        for runner in runners:
+            runner.start()
+        results = [None] * self.jobs
+        errors = []
+        finished = 0
+        # read the results BEFORE joining: a process can't exit while its queue still holds data
+        while finished < self.workers:
+            kind, key, value = self.results.get()
+            if kind == "result":
+                results[key] = value
+            elif kind == "error":
+                errors.append(value)
+            else:
+                self.stats[key] = value
+                finished += 1
+        for runner in runners:
+            runner.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+def busy(n):
+    # CPU-bound busy work
+    total = 0
+    for x in range(n):
+        total += x * x
+    return total
+
+
+async def leaf(x):
+    total = 0
+    for _ in range(5):
+        total += busy(20000)
+        await sleep(0)  # let the other local tasks run
+    return x
+
+
+async def fan_out(n):
+    # all n children start in THIS worker's inbox, the idle workers have to steal them
+    for x in range(n):
+        spawn(leaf, x)
+    return "spawned %d jobs" % n
+
+
+async def square(x):
+    await sleep(0.01)
+    return x * x
+
+
+if __name__ == "__main__":
+    # like async19: worker processes may import this file again
+    multi = MultiScheduler(workers=max(2, os.cpu_count() or 1))
+    print("%d workers, running as %s" % (multi.workers, "threads" if multi.threads else "processes"))
+    multi.new_task(fan_out, 64)
+    for x in range(8):
+        multi.new_task(square, x)
+    start = time.perf_counter()
+    print(multi.run())
+    print("done in %.2fs" % (time.perf_counter() - start))
+    for index, (jobs_run, jobs_stolen) in sorted(multi.stats.items()):
+        print("worker %d ran %3d jobs, %3d of them stolen" % (index, jobs_run, jobs_stolen))
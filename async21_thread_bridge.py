@@ -0,0 +1,436 @@
+# changes: sched.call_soon_threadsafe(func, *args) and a BridgeQueue between threads and coroutines
+#
+# basic_producer_consumer.py: threads + queue.Queue. async10: coroutines + AsyncQueue
+# real programs have both: old worker threads that we can't rewrite today, feeding new async code
+# but the scheduler is NOT thread-safe: another thread must never touch sched.ready directly
+#
+# call_soon_threadsafe() is the one door into the scheduler from other threads:
+# it stores the call in a thread-safe deque and writes to the async18 self-pipe
+# so a scheduler sleeping in select() wakes up immediately and runs the call in its own thread
+# (run_in_thread and run_in_process now use it too)
+#
+# BridgeQueue: threads put() and block while it's full, like queue.Queue
+# coroutines `await get()` and disappear while it's empty, like AsyncQueue
+import heapq
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _run_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler21:
+    def __init__(self, compact_ratio=0.5, max_threads=8, max_processes=None):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        # worker threads are only started the first time somebody needs one
+        self.max_threads = max_threads
+        self.executor = None
+        # same for worker processes, max_processes=None means one per CPU core
+        self.max_processes = max_processes
+        self.process_pool = None
+        self.pending_jobs = 0  # tasks waiting for another thread or a process, they keep run() alive
+        # (func, args) pairs sent by other threads, deque.append and deque.popleft are thread-safe
+        self.threadsafe_calls = deque()
+        # the self-pipe: a thread writes to _wake_w, the selector watches _wake_r
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def _wakeup(self):
+        # may be called from ANY thread
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # the pipe is full of wake up bytes already, the scheduler will wake up anyway
+            pass
+
+    def call_soon_threadsafe(self, func, *args):
+        # the ONLY scheduler method that other threads may call
+        # func(*args) runs in the scheduler's thread, as soon as the scheduler wakes up
+        self.threadsafe_calls.append((func, args))
+        self._wakeup()
+
+    def _job_done(self, task):
+        # runs in a worker thread, or in the thread that collects results from the worker processes
+        self.call_soon_threadsafe(self._resume, task)
+
+    def _resume(self, task):
+        # a task that was waiting for another thread can run again
+        self.pending_jobs -= 1
+        self.ready.append(task)
+
+    async def _run_in_executor(self, executor, func, *args):
+        task = self.current
+        future = executor.submit(func, *args)
+        self.pending_jobs += 1
+        # for both pools, the callback runs in a background thread once the result is back
+        future.add_done_callback(lambda _: self._job_done(task))
+        self.current = None  # disappear until the job is done
+        await switch()
+        return future.result()
+
+    async def run_in_thread(self, func, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        return await self._run_in_executor(self.executor, func, *args)
+
+    async def run_in_process(self, func, *args):
+        # func, args and the result travel between processes, so they must be picklable
+        if self.process_pool is None:
+            # starting processes is slow: do it once, then reuse them for every call
+            self.process_pool = ProcessPoolExecutor(max_workers=self.max_processes)
+        return await self._run_in_executor(self.process_pool, func, *args)
+
+    async def map_in_process(self, func, items, chunksize=1000):
+        # one job per item would spend more time pickling than computing
+        # so we send the items to the worker processes in chunks
+        items = list(items)
+        chunks = [items[start : start + chunksize] for start in range(0, len(items), chunksize)]
+        tasks = [self.new_task(self.run_in_process(_run_chunk, func, chunk)) for chunk in chunks]
+        results = []
+        for task in tasks:
+            results.extend(await task)
+        return results
+
+    # -------------- same Scheduler19 code as in async19
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    # -------------- same Scheduler19 code as in async19
+
+    def _poll(self, timeout):
+        # the self-pipe is always registered, so there's always something to select() on
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if waiters is None:
+                # somebody wrote to the self-pipe: throw the bytes away, self.threadsafe_calls has the news
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        calls = self.threadsafe_calls
+        # len(get_map()) > 1: some socket besides the self-pipe is being watched
+        while (
+            ready
+            or len(sleeping) > self.cancelled_timers
+            or len(self.selector.get_map()) > 1
+            or self.pending_jobs
+        ):
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready or calls:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            while calls:
+                func, args = calls.popleft()
+                func(*args)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+    def close(self):
+        # worker threads, worker processes and the self-pipe outlive run(): give them back at the end
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        self.selector.unregister(self._wake_r)
+        self._wake_r.close()
+        self._wake_w.close()
+        self.selector.close()
+
+
+sched = Scheduler21()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class BridgeQueue:
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize
+        # one lock protects everything below, threads and the scheduler both use it
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)  # threads blocked in put()
+        self.waiting = deque()  # tasks parked in get()
+        self._closed = False
+
+    def put(self, item, timeout=None):
+        # called from a regular thread: blocks like queue.Queue.put()
+        with self.not_full:
+            while 0 < self.maxsize <= len(self.items) and not self._closed:
+                if not self.not_full.wait(timeout):
+                    raise QueueFull()
+            if self._closed:
+                raise QueueClosed()
+            self.items.append(item)
+            if self.waiting:
+                # we can't touch sched.ready from this thread, ask the scheduler to do it
+                sched.call_soon_threadsafe(sched._resume, self.waiting.popleft())
+
+    def close(self):
+        # any thread, or the scheduler
+        with self.lock:
+            self._closed = True
+            self.not_full.notify_all()
+            while self.waiting:
+                sched.call_soon_threadsafe(sched._resume, self.waiting.popleft())
+
+    async def get(self):
+        while True:
+            with self.lock:
+                if self.items:
+                    item = self.items.popleft()
+                    self.not_full.notify()
+                    return item
+                if self._closed:
+                    raise QueueClosed()
+                self.waiting.append(sched.current)
+                # a thread will wake us up: don't let run() exit while we wait
+                sched.pending_jobs += 1
+            sched.current = None
+            await switch()
+
+
+# -------------- the basic_producer_consumer.py producer, a plain old thread
+
+
+def producer(q, count, delay):
+    for n in range(count):
+        time.sleep(delay)
+        q.put((n, time.perf_counter()))
+
+
+def close_when_done(q, threads):
+    for thread in threads:
+        thread.join()
+    q.close()
+
+
+# -------------- an async10 style consumer
+
+
+async def consumer(q, name):
+    delays = []
+    try:
+        while True:
+            n, sent = await q.get()
+            delays.append(time.perf_counter() - sent)
+    except QueueClosed:
+        pass
+    delays.sort()
+    print(
+        "%s got %d items, from put() to get(): median %.0fus, max %.0fus"
+        % (name, len(delays), delays[len(delays) // 2] * 1e6, delays[-1] * 1e6)
+    )
+
+
+async def countdown(n: int) -> None:
+    x = n
+    while x >= 0:
+        print("down", x)
+        await sched.sleep(0.2)
+        x -= 1
+
+
+def legacy_callback_thread():
+    time.sleep(0.3)
+    sched.call_soon_threadsafe(print, "hello from", threading.current_thread().name)
+
+
+q = BridgeQueue(maxsize=10)
+producers = [threading.Thread(target=producer, args=(q, 100, 0.005)) for _ in range(4)]
+for thread in producers:
+    thread.start()
+threading.Thread(target=close_when_done, args=(q, producers)).start()
+threading.Thread(target=legacy_callback_thread, name="legacy thread").start()
+sched.new_task(consumer(q, "consumer"))
+sched.new_task(countdown(3))
+sched.run()
+sched.close()
@@ -0,0 +1,536 @@
+# changes: Scheduler22(instrument=True) measures what happens inside run()
+#
+# when a program built on our scheduler is slow, where does the time go?
+# - how many times did the loop go around, how many task steps did it run?
+# - how long did each coro.send() take, and which task burned the most CPU?
+# - how many tasks were waiting in the ready queue?
+# - how late did sleepers wake up compared to their deadline?
+#
+# measuring costs time too, so it's opt-in: with instrument=False, run() is exactly the async21 loop
+# with instrument=True, run() switches to a copy of the loop that records everything
+# timings go into histograms with a FIXED number of buckets, so memory doesn't grow over time
+# (call_soon_threadsafe is still here, but the BridgeQueue and its thread demo stay in async21)
+import heapq
+import json
+import selectors
+import socket
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _run_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+class Histogram:
+    # fixed-size power-of-two buckets: bucket 0 counts values below 1 unit, bucket i counts [2**(i-1), 2**i)
+    # adding a value is O(1), and the memory never grows no matter how many values we add
+    __slots__ = ("unit", "scale", "counts", "count", "total", "max")
+
+    def __init__(self, unit="us", scale=1e6, buckets=32):
+        self.unit = unit
+        self.scale = scale  # seconds -> microseconds
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        index = int(value * self.scale).bit_length() if value > 0 else 0
+        self.counts[min(index, len(self.counts) - 1)] += 1
+
+    def percentile(self, fraction):
+        # the upper bound of the bucket that holds this percentile
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return 1 << index
+        return 0
+
+    def snapshot(self):
+        return {
+            "unit": self.unit,
+            "count": self.count,
+            "mean": self.total * self.scale / self.count if self.count else 0,
+            "max": self.max * self.scale,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": {"<%d" % (1 << index): count for index, count in enumerate(self.counts) if count},
+        }
+
+
+class SchedulerStats:
+    def __init__(self, keep_finished=100):
+        self.loop_iterations = 0
+        self.task_steps = 0
+        self.step_time = Histogram()  # wall clock time of one coro.send()
+        self.poll_time = Histogram()  # time spent in select(), including sleeping
+        self.timer_lateness = Histogram()  # how long after its deadline a timer actually fired
+        self.ready_depth = Histogram(unit="tasks", scale=1)  # len(ready) at the start of each round
+        # live task -> [name, steps, cpu seconds]
+        # (this keeps parked tasks alive, which is fine for a debugging tool)
+        self.tasks = {}
+        self.finished = deque(maxlen=keep_finished)  # the most recent finished tasks
+
+    def step_done(self, task, name, elapsed, cpu):
+        self.task_steps += 1
+        self.step_time.add(elapsed)
+        record = self.tasks.get(task)
+        if record is None:
+            record = self.tasks[task] = [name, 0, 0.0]
+        record[1] += 1
+        record[2] += cpu
+        if task.done:
+            self.finished.append(self.tasks.pop(task))
+
+    def snapshot(self):
+        def describe(records, state):
+            return [
+                {"task": name, "state": state, "steps": steps, "cpu_ms": cpu * 1000}
+                for name, steps, cpu in records
+            ]
+
+        return {
+            "loop_iterations": self.loop_iterations,
+            "task_steps": self.task_steps,
+            "step_time": self.step_time.snapshot(),
+            "poll_time": self.poll_time.snapshot(),
+            "timer_lateness": self.timer_lateness.snapshot(),
+            "ready_depth": self.ready_depth.snapshot(),
+            "tasks": describe(self.tasks.values(), "pending") + describe(self.finished, "done"),
+        }
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class Scheduler22:
+    def __init__(self, compact_ratio=0.5, max_threads=8, max_processes=None, instrument=False):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        # worker threads are only started the first time somebody needs one
+        self.max_threads = max_threads
+        self.executor = None
+        # same for worker processes, max_processes=None means one per CPU core
+        self.max_processes = max_processes
+        self.process_pool = None
+        self.pending_jobs = 0  # tasks waiting for another thread or a process, they keep run() alive
+        # (func, args) pairs sent by other threads, deque.append and deque.popleft are thread-safe
+        self.threadsafe_calls = deque()
+        # the self-pipe: a thread writes to _wake_w, the selector watches _wake_r
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        # None: no instrumentation at all, run() doesn't even check a flag per task step
+        self.stats = SchedulerStats() if instrument else None
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def _wakeup(self):
+        # may be called from ANY thread
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # the pipe is full of wake up bytes already, the scheduler will wake up anyway
+            pass
+
+    def call_soon_threadsafe(self, func, *args):
+        # the ONLY scheduler method that other threads may call
+        # func(*args) runs in the scheduler's thread, as soon as the scheduler wakes up
+        self.threadsafe_calls.append((func, args))
+        self._wakeup()
+
+    def _job_done(self, task):
+        # runs in a worker thread, or in the thread that collects results from the worker processes
+        self.call_soon_threadsafe(self._resume, task)
+
+    def _resume(self, task):
+        # a task that was waiting for another thread can run again
+        self.pending_jobs -= 1
+        self.ready.append(task)
+
+    async def _run_in_executor(self, executor, func, *args):
+        task = self.current
+        future = executor.submit(func, *args)
+        self.pending_jobs += 1
+        # for both pools, the callback runs in a background thread once the result is back
+        future.add_done_callback(lambda _: self._job_done(task))
+        self.current = None  # disappear until the job is done
+        await switch()
+        return future.result()
+
+    async def run_in_thread(self, func, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        return await self._run_in_executor(self.executor, func, *args)
+
+    async def run_in_process(self, func, *args):
+        # func, args and the result travel between processes, so they must be picklable
+        if self.process_pool is None:
+            # starting processes is slow: do it once, then reuse them for every call
+            self.process_pool = ProcessPoolExecutor(max_workers=self.max_processes)
+        return await self._run_in_executor(self.process_pool, func, *args)
+
+    async def map_in_process(self, func, items, chunksize=1000):
+        # one job per item would spend more time pickling than computing
+        # so we send the items to the worker processes in chunks
+        items = list(items)
+        chunks = [items[start : start + chunksize] for start in range(0, len(items), chunksize)]
+        tasks = [self.new_task(self.run_in_process(_run_chunk, func, chunk)) for chunk in chunks]
+        results = []
+        for task in tasks:
+            results.extend(await task)
+        return results
+
+    # -------------- same Scheduler19 code as in async19
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    # -------------- same Scheduler19 code as in async19
+
+    def _poll(self, timeout):
+        # the self-pipe is always registered, so there's always something to select() on
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if waiters is None:
+                # somebody wrote to the self-pipe: throw the bytes away, self.threadsafe_calls has the news
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    def run(self):
+        if self.stats is not None:
+            return self._run_instrumented()
+        ready = self.ready
+        sleeping = self.sleeping
+        calls = self.threadsafe_calls
+        # len(get_map()) > 1: some socket besides the self-pipe is being watched
+        while (
+            ready
+            or len(sleeping) > self.cancelled_timers
+            or len(self.selector.get_map()) > 1
+            or self.pending_jobs
+        ):
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready or calls:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            while calls:
+                func, args = calls.popleft()
+                func(*args)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+    def _run_instrumented(self):
+        # the same loop as run(), with measurements in between
+        # a copy instead of `if self.stats:` everywhere, so that run() pays nothing for it
+        stats = self.stats
+        clock = time.perf_counter
+        cpu_clock = time.thread_time
+        ready = self.ready
+        sleeping = self.sleeping
+        calls = self.threadsafe_calls
+        while (
+            ready
+            or len(sleeping) > self.cancelled_timers
+            or len(self.selector.get_map()) > 1
+            or self.pending_jobs
+        ):
+            stats.loop_iterations += 1
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready or calls:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            start = clock()
+            self._poll(timeout)
+            stats.poll_time.add(clock() - start)
+
+            while calls:
+                func, args = calls.popleft()
+                func(*args)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                # how late is this timer compared to its deadline?
+                stats.timer_lateness.add(now - handle.deadline)
+                handle.callback(*handle.args)
+
+            stats.ready_depth.add(len(ready))
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                name = task.coro.__qualname__
+                start = clock()
+                cpu_start = cpu_clock()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                stats.step_done(task, name, clock() - start, cpu_clock() - cpu_start)
+        self.current = None
+
+    def close(self):
+        # worker threads, worker processes and the self-pipe outlive run(): give them back at the end
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        self.selector.unregister(self._wake_r)
+        self._wake_r.close()
+        self._wake_w.close()
+        self.selector.close()
+
+
+sched = Scheduler22()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+def busy(n):
+    total = 0
+    for x in range(n):
+        total += x * x
+    return total
+
+
+async def cpu_hog(rounds):
+    # takes a lot of CPU time in each step, everybody else waits
+    for _ in range(rounds):
+        busy(200000)
+        await switch()
+
+
+async def napper(n):
+    for _ in range(n):
+        await sched.sleep(0.01)
+
+
+async def offloaded():
+    await sched.run_in_thread(time.sleep, 0.05)
+
+
+async def main():
+    tasks = [sched.new_task(napper(20)) for _ in range(100)]
+    tasks.append(sched.new_task(cpu_hog(5)))
+    tasks.append(sched.new_task(offloaded()))
+    for task in tasks:
+        await task
+
+
+sched.stats = SchedulerStats(keep_finished=1000)  # same as Scheduler22(instrument=True)
+sched.new_task(main())
+sched.run()
+snapshot = sched.stats.snapshot()
+tasks = snapshot.pop("tasks")
+print(json.dumps(snapshot, indent=1))
+print("most expensive tasks:")
+for task in sorted(tasks, key=lambda task: -task["cpu_ms"])[:3]:
+    print("  %(task)-10s %(state)-8s %(steps)3d steps  %(cpu_ms)6.1fms CPU" % task)
+
+
+# benchmark: how much does the instrumentation cost per task step?
+async def ping(n):
+    for _ in range(n):
+        await switch()
+
+
+def bench_steps(stats, ntasks=100, nsteps=2000):
+    sched.stats = stats
+    for _ in range(ntasks):
+        sched.new_task(ping(nsteps))
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    return elapsed / (ntasks * nsteps) * 1e9
+
+
+print("instrumentation off: %.0fns per task step" % bench_steps(None))
+print("instrumentation on:  %.0fns per task step" % bench_steps(SchedulerStats()))
+sched.close()
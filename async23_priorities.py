@@ -0,0 +1,335 @@
+# changes: `sched.new_task(coro, priority=HIGH)` and a weighted ready queue
+#
+# the ready deque is strict FIFO: a task that wakes up waits behind EVERY task that woke up before it
+# with 1000 busy background tasks, a request handler waits for 1000 steps before it can answer
+#
+# naive fix: always run the high priority tasks first
+# problem: as long as there are high priority tasks, the low priority ones never run ("starvation")
+#
+# solution: weighted round robin, also known as deficit round robin with a cost of 1 per step
+# one deque per priority class, the scheduler visits the classes in turn,
+# and every visit a class may run up to `weight` steps (its "credit") before the next class gets a turn
+# with weights (8, 4, 1): out of 13 steps, HIGH gets 8, NORMAL 4 and LOW 1 when all three are busy
+# a class with nothing to do gives its turn away immediately, so LOW gets everything when it's alone
+#
+# WeightedReady looks like a deque to the scheduler (append, extend, popleft, len),
+# so sleep(), Task.__await__ and _poll put tasks back in the right class without knowing about priorities
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+HIGH, NORMAL, LOW = 0, 1, 2
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "priority")
+
+    def __init__(self, coro, priority=NORMAL):
+        self.coro = coro
+        self.priority = priority  # HIGH, NORMAL or LOW: which deque of WeightedReady the task goes to
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            ready.extend(self.waiters)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        if self.exception is not None and not self.retrieved:
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+
+class WeightedReady:
+    def __init__(self, weights=(8, 4, 1)):
+        self.weights = weights
+        self.queues = [deque() for _ in weights]
+        self.size = 0
+        self.turn = 0  # the class whose turn it is
+        self.credit = weights[0]  # how many more steps it may run this turn
+
+    def append(self, task):
+        self.queues[task.priority].append(task)
+        self.size += 1
+
+    def extend(self, tasks):
+        for task in tasks:
+            self.append(task)
+
+    def popleft(self):
+        if not self.size:
+            raise IndexError("pop from an empty ready queue")
+        while True:
+            queue = self.queues[self.turn]
+            if queue and self.credit > 0:
+                self.credit -= 1
+                self.size -= 1
+                return queue.popleft()
+            # out of credit, or nothing to run: unused credit is NOT saved for later,
+            # otherwise an idle class could come back and run hundreds of steps in a row
+            self.turn = (self.turn + 1) % len(self.queues)
+            self.credit = self.weights[self.turn]
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+
+class Scheduler23:
+    def __init__(self, compact_ratio=0.5, weights=(8, 4, 1), max_batch=16):
+        # weights=None: plain FIFO deque, priorities are ignored (that's Scheduler15)
+        self.ready = deque() if weights is None else WeightedReady(weights)
+        # Scheduler15 runs EVERY ready task before it looks at the timers and sockets again
+        # with 1000 ready tasks, a HIGH task that wakes up would only be noticed 1000 steps later,
+        # so check for timers and I/O at least every `max_batch` steps (selecting on nothing costs nothing)
+        self.max_batch = max_batch
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro, priority=NORMAL):
+        task = Task(coro, priority)
+        self.ready.append(task)
+        return task
+
+    # -------------- same Scheduler15 code as in async15
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.call_later(delay, self.ready.append, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = [None, None]
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.ready.append(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.ready.append(waiters[1])
+                waiters[1] = None
+            remaining = 0
+            if waiters[0] is not None:
+                remaining |= selectors.EVENT_READ
+            if waiters[1] is not None:
+                remaining |= selectors.EVENT_WRITE
+            if remaining:
+                self.selector.modify(key.fileobj, remaining, waiters)
+            else:
+                self.selector.unregister(key.fileobj)
+
+    # -------------- same Scheduler15 code as in async15
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(min(len(ready), self.max_batch)):
+                task = self.current = ready.popleft()
+                try:
+                    task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except Exception as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+        self.current = None
+
+
+sched = Scheduler23()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+def busy_step():
+    # roughly 20 microseconds of real work, like parsing a message
+    return sum(range(400))
+
+
+async def background(running, counter):
+    while running[0]:
+        busy_step()
+        counter[0] += 1
+        await switch()
+
+
+async def request_handler(requests, interval, latencies):
+    # wake up every `interval` seconds and measure how late we are: that's the time spent in the ready queue
+    for _ in range(requests):
+        deadline = time.monotonic() + interval
+        await sched.sleep(interval)
+        latencies.append(time.monotonic() - deadline)
+        busy_step()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def stop_when_done(handler, running):
+    await handler
+    running[0] = False  # the background tasks would run forever
+
+
+def benchmark(weights, background_tasks=1000, requests=200, interval=0.002):
+    global sched
+    sched = Scheduler23(weights=weights)
+    running = [True]
+    latencies = []
+    normal_steps = [0]
+    low_steps = [0]
+    for x in range(background_tasks):
+        if x % 2:
+            sched.new_task(background(running, normal_steps), NORMAL)
+        else:
+            sched.new_task(background(running, low_steps), LOW)
+    handler = sched.new_task(request_handler(requests, interval, latencies), HIGH)
+    sched.new_task(stop_when_done(handler, running), HIGH)
+    start = time.monotonic()
+    sched.run()
+    elapsed = time.monotonic() - start
+    name = "FIFO" if weights is None else "weights %r" % (weights,)
+    print(
+        "%-18s HIGH p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms | NORMAL %6.0f steps/s  LOW %6.0f steps/s"
+        % (
+            name,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000,
+            normal_steps[0] / elapsed,
+            low_steps[0] / elapsed,
+        )
+    )
+
+
+# FIFO: the handler waits behind all 1000 background tasks, every time it wakes up
+# weighted: it waits for at most 4 NORMAL steps and 1 LOW step, and LOW still makes progress
+print("1000 background tasks, one HIGH priority request handler waking up every 2 ms")
+benchmark(None)
+benchmark((8, 4, 1))
+benchmark((1, 1, 1))
@@ -0,0 +1,472 @@
+# changes: task.cancel() and `await wait_for(coro, timeout)`
+#
+# a task that waits for an item that never comes sits in AsyncQueue.waiting forever
+# a request that nobody cares about anymore keeps sleeping, keeps its timer, and keeps all its memory
+#
+# a coroutine can only be stopped from the outside at the point where it is paused: at a yield
+# coro.send(None) resumes it normally, coro.throw(exception) resumes it by raising `exception` at that yield
+# so task.cancel() marks the task, and the next time the scheduler runs it, it throws Cancelled instead
+# the coroutine can clean up with try/finally (or even catch it), and otherwise Cancelled ends the task
+#
+# a cancelled task may be parked somewhere: a queue's waiting deque, another task's waiters, a timer
+# task.waiting_on remembers where, so cancel() can take the task out of there and put it in the ready queue
+# every place that parks a task has a .remove(task): deques and lists already do, TimerHandle and IOWaiters get one
+# and everything that wakes a task up goes through sched.wake(task), which forgets waiting_on again
+#
+# Cancelled is a BaseException, not an Exception, so `except Exception:` doesn't swallow it by accident
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    # -------------- same Scheduler15 code as in async15
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    # -------------- same Scheduler15 code as in async15
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+async def wait_for(coro, timeout):
+    # run coro as a child task: on timeout the CHILD gets Cancelled, and the caller gets Timeout
+    task = coro if isinstance(coro, Task) else sched.new_task(coro)
+    timed_out = False
+
+    def expire():
+        nonlocal timed_out
+        timed_out = True
+        task.cancel()
+
+    handle = sched.call_later(timeout, expire)
+    try:
+        return await task
+    except Cancelled:
+        if not task.done:
+            # it's the caller that was cancelled, while it waited: don't leave the child behind
+            task.cancel()
+        elif timed_out:
+            raise Timeout("timed out after %s seconds" % timeout) from None
+        raise
+    finally:
+        handle.cancel()  # finished in time: the timer goes away (lazily, see async14)
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize  # 0 means no limit, like queue.Queue
+        self.waiting = deque()  # getters waiting for an item
+        self.putters = deque()  # putters waiting for a free spot
+        self._closed = False
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        # wake up EVERYBODY: getters drain what is left and then see QueueClosed, putters see it right away
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+        for task in self.putters:
+            sched.wake(task)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+        if self.waiting:
+            sched.wake(self.waiting.popleft())
+
+    async def put(self, item):
+        while self.full() and not self._closed:
+            # no room: disappear until a getter makes some
+            self.putters.append(sched.current)
+            sched.current.waiting_on = self.putters
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # a getter may have woken us up for a free spot just before we were cancelled: pass it on
+                if self.putters and not self.full():
+                    sched.wake(self.putters.popleft())
+                raise
+        self.put_nowait(item)
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current.waiting_on = self.waiting
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # same thing: don't take the wake up for this item to the grave
+                if self.waiting and self.items:
+                    sched.wake(self.waiting.popleft())
+                raise
+        item = self.items.popleft()
+        if self.putters:
+            # we just made room for one more item
+            sched.wake(self.putters.popleft())
+        return item
+
+
+async def slow_request(n):
+    try:
+        await sched.sleep(10)
+        return n
+    finally:
+        # runs when the request is cancelled too: close files, give back connections, ...
+        print("request", n, "cleaned up")
+
+
+async def compute(x):
+    await sched.sleep(0.1)
+    return x * x
+
+
+async def abandoned_request(q):
+    try:
+        return await wait_for(q.get(), 0.05)
+    except Timeout:
+        return None
+
+
+async def main():
+    start = time.monotonic()
+    q = AsyncQueue()
+
+    # in time: the result comes back, and the timeout timer is cancelled
+    print("wait_for(compute(7), 1) =", await wait_for(compute(7), 1))
+
+    # too late: the child is cancelled inside q.get(), and it's gone from q.waiting
+    try:
+        await wait_for(q.get(), 0.2)
+    except Timeout as e:
+        print("q.get():", e, "- tasks waiting for the queue:", len(q.waiting))
+
+    # cancel a task that sleeps: its timer is cancelled with it
+    task = sched.new_task(slow_request(1))
+    await sched.sleep(0.1)
+    print("cancelling", task)
+    task.cancel()
+    try:
+        await task
+    except Cancelled:
+        print("request 1 was cancelled after %.1f seconds" % (time.monotonic() - start))
+
+    # cancel a task that awaits another task: the child keeps running, the parent stops waiting
+    child = sched.new_task(compute(3))
+
+    async def parent():
+        return await child
+
+    parent_task = sched.new_task(parent())
+    await sched.sleep(0)
+    parent_task.cancel()
+    print("child result, without the cancelled parent:", await child)
+
+    # 10000 requests that give up: nothing stays behind in the queue or in the timers
+    requests = [sched.new_task(abandoned_request(q)) for _ in range(10000)]
+    for _ in range(2):
+        await switch()  # once to start the requests, once more to let their wait_for children run q.get()
+    print("while waiting: %d in q.waiting, %d timers" % (len(q.waiting), len(sched.sleeping)))
+    for task in requests:
+        await task
+    print(
+        "after the timeouts: %d in q.waiting, %d timers (%d of them cancelled)"
+        % (len(q.waiting), len(sched.sleeping), sched.cancelled_timers)
+    )
+
+    # a getter that is woken up for an item and cancelled before it runs passes the item on
+    first = sched.new_task(q.get())
+    second = sched.new_task(q.get())
+    await switch()
+    q.put_nowait("for the first one")
+    first.cancel()
+    print("second getter got:", await second)
+    print("all done after %.1f seconds" % (time.monotonic() - start))
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,431 @@
+# changes: TaskGroup and `await gather(coros)` to run many children and wait for them
+#
+# scatter/gather: send 100000 subrequests, then wait until they all answered
+# until now that meant 100000 sched.new_task calls, and then `for task in tasks: await task`
+# and if subrequest 17 fails, the other 99999 keep running for nothing
+#
+# a TaskGroup owns its children:
+#   async with TaskGroup() as group:
+#       group.spawn_many(fetch(url) for url in urls)
+#   # here EVERY child is done
+# - spawn_many creates all the Tasks and puts them in the ready queue with ONE deque.extend
+# - the group counts its running children: every child decrements the counter when it's done,
+#   and the child that makes the counter hit 0 wakes up the waiting parent. no polling, no rescanning a list:
+#   the work per child is constant, so 10^5 children cost 100 times what 10^3 cost
+# - the first child that fails cancels its siblings (async24), and the parent gets its exception
+# - the parent can also wait for just the first N results: group.wait(N), or gather(coros, first=N)
+import heapq
+import random
+import selectors
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+class TaskGroup:
+    def __init__(self):
+        self.tasks = []
+        self.pending = 0  # children that are still running
+        self.done = []  # children that returned a result, in the order they finished
+        self.error = None  # the exception of the first child that failed
+        self.parent = None  # the task parked in wait()
+        self.need = None  # how many results the parent is waiting for, None means all of them
+
+    def spawn(self, coro):
+        task = sched.new_task(self._child(coro))
+        self.tasks.append(task)
+        self.pending += 1
+        return task
+
+    def spawn_many(self, coros):
+        tasks = [Task(self._child(coro)) for coro in coros]
+        sched.ready.extend(tasks)
+        self.tasks.extend(tasks)
+        self.pending += len(tasks)
+        return tasks
+
+    async def _child(self, coro):
+        try:
+            result = await coro
+            self.done.append(sched.current)
+            return result
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+                self.cancel()
+            raise
+        finally:
+            self.pending -= 1
+            if self.parent is not None and self._satisfied(self.need):
+                sched.wake(self.parent)
+                self.parent = None
+
+    def _satisfied(self, count):
+        if self.pending == 0:
+            return True
+        # after a failure, wait for the cancelled siblings to finish their cleanup
+        return self.error is None and count is not None and len(self.done) >= count
+
+    async def wait(self, count=None):
+        # park until `count` children returned a result (all of them by default), or until a failure
+        while not self._satisfied(count):
+            self.need = count
+            self.parent = sched.current
+            sched.current.waiting_on = self
+            sched.current = None
+            await switch()
+
+    def remove(self, task):
+        # the parent was cancelled while it waited (see Task.cancel)
+        self.parent = None
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()  # does nothing to tasks that are done already
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # the body of the `async with` failed, or was cancelled: the children go too
+            self.cancel()
+        try:
+            await self.wait()
+        except Cancelled:
+            # the parent was cancelled while it waited: cancel the children, and let them clean up first
+            self.cancel()
+            await self.wait()
+            raise
+        for task in self.tasks:
+            task.retrieved = True  # the group reports the first failure, don't complain about the others
+        if self.error is not None and exc_type is None:
+            raise self.error
+        return False
+
+
+async def gather(coros, first=None):
+    # the results of all coros in order, or the first `first` results in the order they arrived
+    group = TaskGroup()
+    async with group:
+        tasks = group.spawn_many(coros)
+        if first is not None:
+            await group.wait(first)
+            group.cancel()  # we have enough: the others can stop
+    if first is None:
+        return [task.result for task in tasks]
+    return [task.result for task in group.done[:first]]
+
+
+async def fetch(n, delay):
+    try:
+        await sched.sleep(delay)
+        if n == 13:
+            raise ConnectionError("subrequest %d failed" % n)
+        return n * 10
+    except Cancelled:
+        cancelled[0] += 1
+        raise
+
+
+async def subrequest(delay):
+    await sched.sleep(delay)
+    return 1
+
+
+cancelled = [0]
+
+
+async def main():
+    start = time.monotonic()
+    async with TaskGroup() as group:
+        first = group.spawn(fetch(1, 0.3))
+        second = group.spawn(fetch(2, 0.1))
+    print("group done after %.1f seconds:" % (time.monotonic() - start), first.result, second.result)
+
+    print("gather:", await gather(fetch(n, 0.1 * (5 - n)) for n in range(5)))
+    print("first 2:", await gather((fetch(n, 0.1 * (5 - n)) for n in range(5)), first=2))
+
+    # subrequest 13 fails after 0.1 seconds, the other 99 would take a second
+    start = time.monotonic()
+    cancelled[0] = 0
+    try:
+        await gather(fetch(n, 0.1 if n == 13 else 1) for n in range(100))
+    except ConnectionError as e:
+        print("%s after %.1f seconds, %d siblings cancelled" % (e, time.monotonic() - start, cancelled[0]))
+
+    # the time per subrequest doesn't grow with the number of subrequests
+    random.seed(0)
+    for n in (10**3, 10**4, 10**5):
+        delays = [random.uniform(0, 0.01) for _ in range(n)]
+        start = time.monotonic()
+        total = sum(await gather(subrequest(delay) for delay in delays))
+        elapsed = time.monotonic() - start
+        print("gather %6d subrequests: %5.2f seconds, %5.2f us each" % (total, elapsed, elapsed / n * 10**6))
+
+
+sched.new_task(main())
+sched.run()
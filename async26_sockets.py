@@ -0,0 +1,549 @@
+# changes: sock_accept, sock_connect, sock_recv, sock_recv_into and sock_sendall coroutines
+#
+# wait_readable/wait_writable (async11) are the building blocks, but every caller had to write the same loop:
+#   try the system call, and if the socket isn't ready yet (BlockingIOError), wait for it and try again
+# now the scheduler does that for the 5 operations a TCP client or server needs
+#
+# the system call is ALWAYS tried first: most of the time the data is already there (or the send buffer
+# has room), and then the task doesn't park at all and the selector isn't touched
+# only when the socket really isn't ready does the task disappear into the selector
+#
+# sock_sendall keeps a memoryview of the data, so sending the rest after a partial send doesn't copy it
+# sock_connect on a non-blocking socket returns right away (EINPROGRESS): the connection is established
+# when the socket becomes writable, and SO_ERROR tells if that was a success
+#
+# the demo is an echo server and a load generator with 1, 100 and 10000 connections, all in one process
+import heapq
+import os
+import selectors
+import socket
+import time
+import traceback
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler26:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    async def sock_accept(self, sock):
+        while True:
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+            else:
+                conn.setblocking(False)
+                return conn, address
+
+    async def sock_connect(self, sock, address):
+        try:
+            sock.connect(address)
+        except (BlockingIOError, InterruptedError):
+            # EINPROGRESS: the connection is being established in the background
+            await self.wait_writable(sock)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, "connect to %r failed: %s" % (address, os.strerror(err)))
+
+    async def sock_recv(self, sock, nbytes):
+        while True:
+            try:
+                return sock.recv(nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_recv_into(self, sock, buffer, nbytes=0):
+        while True:
+            try:
+                return sock.recv_into(buffer, nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_sendall(self, sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                sent = sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_writable(sock)
+            else:
+                view = view[sent:]
+
+    # -------------- same Scheduler24 code as in async24
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+    # -------------- same Scheduler24 code as in async24
+
+
+sched = Scheduler26()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same TaskGroup code as in async25
+
+
+class TaskGroup:
+    def __init__(self):
+        self.tasks = []
+        self.pending = 0  # children that are still running
+        self.done = []  # children that returned a result, in the order they finished
+        self.error = None  # the exception of the first child that failed
+        self.parent = None  # the task parked in wait()
+        self.need = None  # how many results the parent is waiting for, None means all of them
+
+    def spawn(self, coro):
+        task = sched.new_task(self._child(coro))
+        self.tasks.append(task)
+        self.pending += 1
+        return task
+
+    def spawn_many(self, coros):
+        tasks = [Task(self._child(coro)) for coro in coros]
+        sched.ready.extend(tasks)
+        self.tasks.extend(tasks)
+        self.pending += len(tasks)
+        return tasks
+
+    async def _child(self, coro):
+        try:
+            result = await coro
+            self.done.append(sched.current)
+            return result
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+                self.cancel()
+            raise
+        finally:
+            self.pending -= 1
+            if self.parent is not None and self._satisfied(self.need):
+                sched.wake(self.parent)
+                self.parent = None
+
+    def _satisfied(self, count):
+        if self.pending == 0:
+            return True
+        # after a failure, wait for the cancelled siblings to finish their cleanup
+        return self.error is None and count is not None and len(self.done) >= count
+
+    async def wait(self, count=None):
+        # park until `count` children returned a result (all of them by default), or until a failure
+        while not self._satisfied(count):
+            self.need = count
+            self.parent = sched.current
+            sched.current.waiting_on = self
+            sched.current = None
+            await switch()
+
+    def remove(self, task):
+        # the parent was cancelled while it waited (see Task.cancel)
+        self.parent = None
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()  # does nothing to tasks that are done already
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # the body of the `async with` failed, or was cancelled: the children go too
+            self.cancel()
+        try:
+            await self.wait()
+        except Cancelled:
+            # the parent was cancelled while it waited: cancel the children, and let them clean up first
+            self.cancel()
+            await self.wait()
+            raise
+        for task in self.tasks:
+            task.retrieved = True  # the group reports the first failure, don't complain about the others
+        if self.error is not None and exc_type is None:
+            raise self.error
+        return False
+
+
+async def gather(coros, first=None):
+    # the results of all coros in order, or the first `first` results in the order they arrived
+    group = TaskGroup()
+    async with group:
+        tasks = group.spawn_many(coros)
+        if first is not None:
+            await group.wait(first)
+            group.cancel()  # we have enough: the others can stop
+    if first is None:
+        return [task.result for task in tasks]
+    return [task.result for task in group.done[:first]]
+
+
+# -------------- same TaskGroup code as in async25
+
+MESSAGE_SIZE = 64
+
+
+async def echo_handler(conn):
+    try:
+        while True:
+            data = await sched.sock_recv(conn, 65536)
+            if not data:
+                break  # the client closed the connection
+            await sched.sock_sendall(conn, data)
+    except ConnectionError:
+        pass
+    finally:
+        conn.close()
+
+
+async def echo_server(listener):
+    while True:
+        conn, _ = await sched.sock_accept(listener)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sched.new_task(echo_handler(conn))
+
+
+async def connect(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    await sched.sock_connect(sock, address)
+    return sock
+
+
+async def client(sock, requests, latencies):
+    message = b"x" * MESSAGE_SIZE
+    buffer = bytearray(MESSAGE_SIZE)
+    view = memoryview(buffer)
+    for _ in range(requests):
+        start = time.perf_counter()
+        await sched.sock_sendall(sock, message)
+        received = 0
+        while received < MESSAGE_SIZE:
+            n = await sched.sock_recv_into(sock, view[received:])
+            if not n:
+                raise ConnectionError("the server closed the connection")
+            received += n
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def fd_limit(wanted):
+    # every connection needs 2 file descriptors here: the client's and the server's
+    if resource is None:
+        return True
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted and (hard == resource.RLIM_INFINITY or hard >= wanted):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        soft = wanted
+    return soft >= wanted
+
+
+async def load(address, connections, total_requests):
+    if not fd_limit(2 * connections + 64):
+        print("%5d connections: skipped, not enough file descriptors (ulimit -n)" % connections)
+        return
+    # connect first, at most 1000 at a time so the listen backlog doesn't overflow
+    socks = []
+    for first in range(0, connections, 1000):
+        count = min(1000, connections - first)
+        socks += await gather(connect(address) for _ in range(count))
+
+    latencies = []
+    requests = max(1, total_requests // connections)
+    start = time.perf_counter()
+    await gather(client(sock, requests, latencies) for sock in socks)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(
+        "%5d connections: %6d requests/s  latency p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms"
+        % (
+            connections,
+            len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000,
+        )
+    )
+
+
+async def main():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))  # port 0: any free port
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    address = listener.getsockname()
+    print("echo server on %s:%d, %d byte messages" % (address + (MESSAGE_SIZE,)))
+    server = sched.new_task(echo_server(listener))
+
+    for connections in (1, 100, 10000):
+        await load(address, connections, 20000)
+
+    server.cancel()  # stop accepting, so run() can return
+    try:
+        await server
+    except Cancelled:
+        pass
+    listener.close()
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,611 @@
+# changes: StreamReader and StreamWriter, buffered streams that don't allocate per message
+#
+# `data = await sched.sock_recv(sock, 65536)` creates a new bytes object for every chunk
+# and then the framing makes more: buffer += data to glue chunks together, buffer[:n] and buffer[n:] to cut
+# them apart, every one of them a new object and a copy. for small messages that's most of the work
+#
+# StreamReader owns ONE bytearray, allocated once, and sock_recv_into fills it in place
+# readexactly(n) and readuntil(b"\n") return a memoryview of that bytearray: no copy, no new bytes object
+# the catch: the memoryview is only valid until the next read, call bytes(view) to keep the data
+# (a real ring buffer would split messages at the end of the buffer: instead, when there is no room
+# left at the end, the unread bytes are moved back to the start, which is rare and cheap)
+#
+# StreamWriter coalesces: write() copies small messages into ONE bytearray, and drain() sends
+# everything that was written with one sendmsg() (writev: many buffers, one system call)
+# a write that doesn't fit in the buffer isn't copied into it: bytes are sent from where they are
+import heapq
+import os
+import selectors
+import socket
+import time
+import traceback
+import tracemalloc
+from collections import deque
+
+IOV_MAX = 1024  # the most buffers sendmsg() accepts at once on Linux
+HERE = [tracemalloc.Filter(True, __file__)]  # only count what the code in this file allocates
+
+# -------------- same Scheduler26 code as in async26
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler26:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    async def sock_accept(self, sock):
+        while True:
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+            else:
+                conn.setblocking(False)
+                return conn, address
+
+    async def sock_connect(self, sock, address):
+        try:
+            sock.connect(address)
+        except (BlockingIOError, InterruptedError):
+            # EINPROGRESS: the connection is being established in the background
+            await self.wait_writable(sock)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, "connect to %r failed: %s" % (address, os.strerror(err)))
+
+    async def sock_recv(self, sock, nbytes):
+        while True:
+            try:
+                return sock.recv(nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_recv_into(self, sock, buffer, nbytes=0):
+        while True:
+            try:
+                return sock.recv_into(buffer, nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_sendall(self, sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                sent = sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_writable(sock)
+            else:
+                view = view[sent:]
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler26()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler26 code as in async26
+
+
+class IncompleteRead(EOFError):
+    pass
+
+
+class LimitOverrun(Exception):
+    pass
+
+
+class StreamReader:
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # the unread bytes are buffer[start:end]
+        self.end = 0
+        self.eof = False
+
+    @property
+    def buffered(self):
+        return self.end - self.start
+
+    def _compact(self):
+        # move the unread bytes to the start of the buffer, to make room at the end
+        n = self.end - self.start
+        self.view[:n] = self.view[self.start : self.end]
+        self.start = 0
+        self.end = n
+
+    async def _fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0  # everything was read: start over for free
+        elif self.end == len(self.buffer):
+            if self.start == 0:
+                raise LimitOverrun("message doesn't fit in the %d byte buffer" % len(self.buffer))
+            self._compact()
+        n = await sched.sock_recv_into(self.sock, self.view[self.end :])
+        if not n:
+            self.eof = True
+        self.end += n
+
+    async def read(self, n=-1):
+        # whatever is buffered (up to n bytes), waiting only if nothing is. b"" at the end of the stream
+        if self.start == self.end and not self.eof:
+            await self._fill()
+        end = self.end if n < 0 else min(self.end, self.start + n)
+        view = self.view[self.start : end]
+        self.start = end
+        return view
+
+    async def readexactly(self, n):
+        if n > len(self.buffer):
+            raise LimitOverrun("can't read %d bytes with a %d byte buffer" % (n, len(self.buffer)))
+        while self.end - self.start < n:
+            if self.eof:
+                raise IncompleteRead("expected %d bytes, got %d" % (n, self.end - self.start))
+            if self.start + n > len(self.buffer):
+                self._compact()
+            await self._fill()
+        view = self.view[self.start : self.start + n]
+        self.start += n
+        return view
+
+    async def readuntil(self, separator=b"\n"):
+        # everything up to and including the separator
+        searched = self.start  # don't search the same bytes again after every recv
+        while True:
+            i = self.buffer.find(separator, searched, self.end)
+            if i >= 0:
+                break
+            if self.eof:
+                raise IncompleteRead("%r not found before the end of the stream" % separator)
+            searched = max(self.start, self.end - len(separator) + 1) - self.start
+            await self._fill()
+            searched += self.start  # _fill may have moved the unread bytes to the start
+        end = i + len(separator)
+        view = self.view[self.start : end]
+        self.start = end
+        return view
+
+
+class StreamWriter:
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.end = 0  # buffer[:end] is written but not sent yet
+        self.sealed = 0  # buffer[:sealed] is in self.chunks already
+        self.chunks = []  # what the next sendmsg() sends, in order
+
+    def write(self, data):
+        n = len(data)
+        if self.end + n <= len(self.buffer):
+            self.buffer[self.end : self.end + n] = data  # same size: a copy, not an allocation
+            self.end += n
+        else:
+            # too big for what's left of the buffer: don't copy it into the buffer, send it from where it is
+            # only bytes can't change before drain(): a memoryview (from a StreamReader, say) or a bytearray
+            # can be overwritten by the next read, so those are copied once
+            self._seal()
+            self.chunks.append(data if type(data) is bytes else bytes(data))
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def _seal(self):
+        if self.end > self.sealed:
+            self.chunks.append(self.view[self.sealed : self.end])
+            self.sealed = self.end
+
+    async def drain(self):
+        self._seal()
+        chunks = self.chunks
+        while chunks:
+            try:
+                sent = self.sock.sendmsg(chunks if len(chunks) <= IOV_MAX else chunks[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                await sched.wait_writable(self.sock)
+                continue
+            # forget what was sent, the first chunk may have been sent partially
+            done = 0
+            while done < len(chunks) and sent >= len(chunks[done]):
+                sent -= len(chunks[done])
+                done += 1
+            del chunks[:done]
+            if sent:
+                chunks[0] = memoryview(chunks[0])[sent:]
+        self.end = self.sealed = 0
+
+    def close(self):
+        self.sock.close()
+
+
+# -------------- a length-prefixed echo protocol: a 4 byte big endian length, then the message
+
+
+async def naive_frames(sock):
+    buffer = b""
+    while True:
+        data = await sched.sock_recv(sock, 65536)
+        if not data:
+            return
+        buffer += data
+        while len(buffer) >= 4:
+            n = int.from_bytes(buffer[:4], "big")
+            if len(buffer) < 4 + n:
+                break
+            message = buffer[4 : 4 + n]
+            buffer = buffer[4 + n :]
+            await sched.sock_sendall(sock, len(message).to_bytes(4, "big") + message)
+
+
+async def stream_frames(sock):
+    reader = StreamReader(sock)
+    writer = StreamWriter(sock)
+    try:
+        while True:
+            if not reader.buffered:
+                await writer.drain()  # nothing more to answer right now: send the whole batch
+            header = await reader.readexactly(4)
+            writer.write(header)
+            writer.write(await reader.readexactly(int.from_bytes(header, "big")))
+    except IncompleteRead:
+        await writer.drain()
+
+
+# -------------- a line protocol: every message ends with b"\n"
+
+
+async def naive_lines(sock):
+    buffer = b""
+    while True:
+        data = await sched.sock_recv(sock, 65536)
+        if not data:
+            return
+        buffer += data
+        while True:
+            i = buffer.find(b"\n")
+            if i < 0:
+                break
+            line = buffer[: i + 1]
+            buffer = buffer[i + 1 :]
+            await sched.sock_sendall(sock, line)
+
+
+async def stream_lines(sock):
+    reader = StreamReader(sock)
+    writer = StreamWriter(sock)
+    try:
+        while True:
+            if not reader.buffered:
+                await writer.drain()
+            writer.write(await reader.readuntil(b"\n"))
+    except IncompleteRead:
+        await writer.drain()
+
+
+async def client(sock, batch, rounds, memory=None, objects=None):
+    # pipelining: send a batch of requests, then read all the answers
+    expected = len(batch)
+    buffer = bytearray(expected)
+    view = memoryview(buffer)
+    for n in range(rounds):
+        if n == 1 and memory is not None:
+            # the buffers exist by now: from here on, only count what is allocated on top of them
+            tracemalloc.reset_peak()
+            memory.append(tracemalloc.get_traced_memory()[0])
+        if n == 1 and objects is not None:
+            steady = tracemalloc.take_snapshot().filter_traces(HERE)
+        await sched.sock_sendall(sock, batch)
+        received = 0
+        while received < expected:
+            got = await sched.sock_recv_into(sock, view[received:])
+            if not got:
+                raise IncompleteRead("connection closed after %d of %d bytes" % (received, expected))
+            received += got
+            if n and objects is not None:
+                # the server is paused in the middle of a batch: count the blocks it allocated and still holds
+                diff = tracemalloc.take_snapshot().filter_traces(HERE).compare_to(steady, "lineno")
+                objects.append(sum(stat.count_diff for stat in diff if stat.count_diff > 0))
+    if memory is not None:
+        memory.append(tracemalloc.get_traced_memory()[1])
+    assert buffer == batch
+    sock.shutdown(socket.SHUT_WR)  # EOF for the server
+
+
+async def run(server, batch, rounds, memory=None, objects=None):
+    client_sock, server_sock = socket.socketpair()
+    client_sock.setblocking(False)
+    server_sock.setblocking(False)
+    server_task = sched.new_task(server(server_sock))
+    await sched.new_task(client(client_sock, batch, rounds, memory, objects))
+    await server_task
+    client_sock.close()
+    server_sock.close()
+
+
+async def main():
+    message = b"x" * 60
+    count = 1000  # 64 KB per batch
+    frames = (len(message).to_bytes(4, "big") + message) * count
+    lines = (message + b"\n") * count
+    rounds = 200
+    print("%d messages of %d bytes, in batches of %d" % (count * rounds, len(message), count))
+    for name, server, batch in (
+        ("naive frames", naive_frames, frames),
+        ("stream frames", stream_frames, frames),
+        ("naive lines", naive_lines, lines),
+        ("stream lines", stream_lines, lines),
+    ):
+        start = time.perf_counter()
+        await run(server, batch, rounds)
+        elapsed = time.perf_counter() - start
+
+        # tracemalloc sees every allocation, and slows everything down: measure separately, with fewer rounds
+        # the peak above the steady state is what the framing allocates while it works: bytes objects,
+        # slices, concatenations. with streams, only a few small memoryview objects are left
+        memory = []
+        tracemalloc.start()
+        await run(server, batch, 10, memory)
+        tracemalloc.stop()
+
+        # and how many of those allocations are there? diffing snapshots counts blocks, not bytes
+        # (taking a snapshot allocates too, so this is a run of its own)
+        objects = []
+        tracemalloc.start()
+        await run(server, batch, 10, objects=objects)
+        tracemalloc.stop()
+        print(
+            "%-13s %7.0f messages/s  allocated on top of the buffers: %7d bytes, %3d blocks at most"
+            % (name, count * rounds / elapsed, memory[1] - memory[0], max(objects))
+        )
+
+
+sched.new_task(main())
+sched.run()
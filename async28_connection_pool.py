@@ -0,0 +1,597 @@
+# changes: ConnectionPool, reuse connections instead of opening a new one for every request
+#
+# opening a connection costs a round trip, often several (TCP handshake, TLS, login, ...)
+# for a short request that's most of the latency, and the server has to accept all those connections too
+#
+#   pool = ConnectionPool(connect, max_size=10, idle_timeout=30)
+#   async with pool.connection() as conn:
+#       ...
+#
+# - acquire() hands out an idle connection if there is one, opens a new one if there are fewer than
+#   max_size, and otherwise parks the task in pool.waiting until somebody releases a connection
+# - idle connections are reused LIFO: the most recently used one first, so under light load a few
+#   connections stay warm and the others get old and expire
+# - expiry needs no task that wakes up every second to look for old connections: release() starts
+#   a call_later(idle_timeout) timer for the connection, and acquire() cancels it (async14 made that cheap)
+# - check(conn) runs before an idle connection is handed out: the server may have closed it meanwhile
+# - a connection that was in use when an exception happened is closed, not reused: who knows what state it is in
+import heapq
+import os
+import selectors
+import socket
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler26 code as in async26
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler26:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    async def sock_accept(self, sock):
+        while True:
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+            else:
+                conn.setblocking(False)
+                return conn, address
+
+    async def sock_connect(self, sock, address):
+        try:
+            sock.connect(address)
+        except (BlockingIOError, InterruptedError):
+            # EINPROGRESS: the connection is being established in the background
+            await self.wait_writable(sock)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, "connect to %r failed: %s" % (address, os.strerror(err)))
+
+    async def sock_recv(self, sock, nbytes):
+        while True:
+            try:
+                return sock.recv(nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_recv_into(self, sock, buffer, nbytes=0):
+        while True:
+            try:
+                return sock.recv_into(buffer, nbytes)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_sendall(self, sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                sent = sock.send(view)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_writable(sock)
+            else:
+                view = view[sent:]
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler26()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler26 code as in async26
+
+
+class PoolClosed(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, max_size=10, idle_timeout=30.0, check=None):
+        self.connect = connect  # async function that opens a new connection, anything with a close()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check = check  # function(conn) -> False if an idle connection can't be used anymore
+        self.idle = {}  # idle connection -> TimerHandle of its expiry, in the order they were released
+        self.size = 0  # idle + in use + being opened
+        self.waiting = deque()  # tasks waiting for a connection
+        self.woken = set()  # woken up for a connection or a free spot, and haven't run yet
+        self.closed = False
+        self.opened = 0
+        self.reused = 0
+        self.expired = 0
+
+    async def acquire(self):
+        while True:
+            if self.closed:
+                raise PoolClosed()
+            while self.idle:
+                conn, handle = self.idle.popitem()  # the last one released: LIFO
+                handle.cancel()
+                if self.check is None or self.check(conn):
+                    self.reused += 1
+                    return conn
+                self._discard(conn)
+            if self.size < self.max_size:
+                self.size += 1  # count it right away, so nobody else opens one more than max_size
+                try:
+                    conn = await self.connect()
+                except BaseException:
+                    self.size -= 1
+                    self._wake_one()  # there's room again, maybe the next one is luckier
+                    raise
+                self.opened += 1
+                return conn
+            task = sched.current
+            self.waiting.append(task)
+            task.waiting_on = self.waiting
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                if task in self.woken:
+                    # don't take the wake up for a released connection to the grave
+                    self.woken.discard(task)
+                    self._wake_one()
+                raise
+            self.woken.discard(task)
+
+    def release(self, conn, discard=False):
+        if discard or self.closed:
+            self._discard(conn)
+        else:
+            self.idle[conn] = sched.call_later(self.idle_timeout, self._expire, conn)
+        self._wake_one()
+
+    def connection(self):
+        return PooledConnection(self)
+
+    def _wake_one(self):
+        if self.waiting:
+            task = self.waiting.popleft()
+            self.woken.add(task)
+            sched.wake(task)
+
+    def _expire(self, conn):
+        del self.idle[conn]
+        self.expired += 1
+        self._discard(conn)
+
+    def _discard(self, conn):
+        self.size -= 1
+        conn.close()
+
+    def close(self):
+        self.closed = True
+        for conn, handle in self.idle.items():
+            handle.cancel()
+            self._discard(conn)
+        self.idle.clear()
+        # waiting tasks wake up and see PoolClosed, connections in use are closed when they are released
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+
+    def __repr__(self):
+        return "<ConnectionPool %d open, %d idle, %d waiting: %d opened, %d reused, %d expired>" % (
+            self.size,
+            len(self.idle),
+            len(self.waiting),
+            self.opened,
+            self.reused,
+            self.expired,
+        )
+
+
+class PooledConnection:
+    __slots__ = ("pool", "conn")
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.acquire()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.conn, discard=exc_type is not None)
+        self.conn = None
+        return False
+
+
+def socket_alive(sock):
+    # an idle connection has nothing to read: if there IS something, it's the end of the stream (b"")
+    # or something we didn't ask for. either way, don't use it
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+# -------------- a loopback server: every connection starts with a slow "handshake", then ping -> pong
+
+HANDSHAKE = 0.005  # pretend TLS: 5 ms before a new connection can be used
+
+
+async def handle(conn):
+    try:
+        await sched.sleep(HANDSHAKE)
+        await sched.sock_sendall(conn, b"helo")
+        while True:
+            request = await sched.sock_recv(conn, 4)
+            if not request:
+                break
+            await sched.sock_sendall(conn, b"pong")
+    except ConnectionError:
+        pass
+    finally:
+        conn.close()
+
+
+async def server(listener, handlers):
+    while True:
+        conn, _ = await sched.sock_accept(listener)
+        task = sched.new_task(handle(conn))
+        handlers.append(task)
+
+
+async def recv_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = await sched.sock_recv(sock, n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by the server")
+        data += chunk
+    return data
+
+
+def connector(address):
+    async def connect():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await sched.sock_connect(sock, address)
+            await recv_exactly(sock, 4)  # wait for the handshake
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    return connect
+
+
+async def ping(sock):
+    await sched.sock_sendall(sock, b"ping")
+    return await recv_exactly(sock, 4)
+
+
+async def worker_without_pool(connect, requests, latencies):
+    for _ in range(requests):
+        start = time.perf_counter()
+        sock = await connect()
+        await ping(sock)
+        sock.close()
+        latencies.append(time.perf_counter() - start)
+
+
+async def worker_with_pool(pool, requests, latencies):
+    for _ in range(requests):
+        start = time.perf_counter()
+        async with pool.connection() as sock:
+            await ping(sock)
+        latencies.append(time.perf_counter() - start)
+
+
+def report(name, latencies, elapsed):
+    latencies.sort()
+    print(
+        "%-13s %6.0f requests/s  p50 %5.2f ms  p99 %5.2f ms"
+        % (
+            name,
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+        )
+    )
+
+
+async def main():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    handlers = []
+    server_task = sched.new_task(server(listener, handlers))
+    connect = connector(listener.getsockname())
+
+    # 20 workers, 100 requests each
+    latencies = []
+    start = time.perf_counter()
+    for task in [sched.new_task(worker_without_pool(connect, 100, latencies)) for _ in range(20)]:
+        await task
+    report("no pool", latencies, time.perf_counter() - start)
+
+    pool = ConnectionPool(connect, max_size=10, idle_timeout=0.5, check=socket_alive)
+    latencies = []
+    start = time.perf_counter()
+    for task in [sched.new_task(worker_with_pool(pool, 100, latencies)) for _ in range(20)]:
+        await task
+    report("pool of 10", latencies, time.perf_counter() - start)
+    print(pool)
+
+    # the server restarts: every connection in the pool is dead now, check() notices
+    for task in handlers:
+        task.cancel()
+    handlers.clear()
+    await sched.sleep(0.01)
+    async with pool.connection() as sock:
+        print("after a server restart:", await ping(sock), pool)
+
+    # nobody uses the pool for a while: the idle timers close the connections, no polling involved
+    await sched.sleep(0.6)
+    print("after 0.6 idle seconds:", pool)
+
+    pool.close()
+    server_task.cancel()
+    for task in handlers:
+        task.cancel()
+    listener.close()
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,572 @@
+# changes: Event, Lock, Semaphore, BoundedSemaphore and Condition
+#
+# until now, the only way for tasks to coordinate was an AsyncQueue with dummy items in it
+# these are the usual threading primitives, but for tasks, with the trick AsyncQueue.get uses:
+# a task that has to wait appends itself to a deque and disappears from the ready queue (park),
+# and whoever makes progress possible pops it from the deque and puts it back (sched.wake)
+#
+# - acquire and release are O(1): nobody scans a list, a release wakes exactly one task
+#   (compare to "while lock.locked: await switch()": EVERY waiting task runs for EVERY release)
+# - FIFO: release() hands the lock (or the permit) DIRECTLY to the task that waited longest,
+#   so a task that arrives just after a release can't take it away from a task that waited for a minute
+# - cancellation (async24) is safe: a task that was handed the lock but got cancelled before it could
+#   run passes it on to the next waiter, instead of keeping it forever
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+async def park(waiting):
+    # disappear into the deque `waiting` until somebody calls sched.wake(task)
+    task = sched.current
+    waiting.append(task)
+    task.waiting_on = waiting
+    sched.current = None
+    await switch()
+
+
+class Event:
+    def __init__(self):
+        self._set = False
+        self.waiting = deque()
+
+    def is_set(self):
+        return self._set
+
+    def set(self):
+        self._set = True
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+
+    def clear(self):
+        self._set = False
+
+    async def wait(self):
+        if not self._set:
+            await park(self.waiting)
+        return True
+
+
+class Lock:
+    def __init__(self):
+        self._locked = False
+        self.owner = None
+        self.waiting = deque()
+
+    def locked(self):
+        return self._locked
+
+    async def acquire(self):
+        # nobody waits while the lock is free: release() hands it over when there are waiters
+        if not self._locked:
+            self._locked = True
+            self.owner = sched.current
+            return True
+        try:
+            await park(self.waiting)
+        except Cancelled:
+            if self.owner is sched.current:
+                self.release()  # we were handed the lock just before we got cancelled: pass it on
+            raise
+        return True
+
+    def release(self):
+        if not self._locked:
+            raise RuntimeError("release() of an unlocked Lock")
+        if self.waiting:
+            # stays locked: the next owner is the task that waited longest
+            self.owner = self.waiting.popleft()
+            sched.wake(self.owner)
+        else:
+            self._locked = False
+            self.owner = None
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class Semaphore:
+    def __init__(self, value=1):
+        if value < 0:
+            raise ValueError("Semaphore value must be >= 0")
+        self._value = value
+        self.waiting = deque()
+        self.handed = set()  # woken up tasks that were handed a permit, and haven't run yet
+
+    def locked(self):
+        return self._value == 0
+
+    async def acquire(self):
+        if self._value > 0:
+            self._value -= 1
+            return True
+        task = sched.current
+        try:
+            await park(self.waiting)
+        except Cancelled:
+            if task in self.handed:
+                self.handed.discard(task)
+                self.release()
+            raise
+        self.handed.discard(task)
+        return True
+
+    def release(self):
+        if self.waiting:
+            # the permit goes straight to the task that waited longest, _value doesn't change
+            task = self.waiting.popleft()
+            self.handed.add(task)
+            sched.wake(task)
+        else:
+            self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class BoundedSemaphore(Semaphore):
+    # a release() without an acquire() is a bug: find it right away instead of allowing one task too many
+    def __init__(self, value=1):
+        super().__init__(value)
+        self._bound = value
+
+    def release(self):
+        if not self.waiting and self._value >= self._bound:
+            raise ValueError("BoundedSemaphore released too many times")
+        super().release()
+
+
+class Condition:
+    def __init__(self, lock=None):
+        self.lock = Lock() if lock is None else lock
+        self.waiting = deque()
+        self.notified = set()  # woken up tasks that haven't run yet
+
+    async def __aenter__(self):
+        await self.lock.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.lock.release()
+        return False
+
+    async def wait(self):
+        task = sched.current
+        if self.lock.owner is not task:
+            raise RuntimeError("wait() without holding the lock")
+        self.lock.release()
+        try:
+            await park(self.waiting)
+        except Cancelled:
+            if task in self.notified:
+                self._wake(1)  # we were notified just before we got cancelled: pass it on
+            raise
+        finally:
+            self.notified.discard(task)
+            # get the lock back, even when cancelled: the `async with` around us will release it
+            cancelled = None
+            while True:
+                try:
+                    await self.lock.acquire()
+                    break
+                except Cancelled as e:
+                    cancelled = e
+            if cancelled is not None:
+                raise cancelled
+        return True
+
+    async def wait_for(self, predicate):
+        while not predicate():
+            await self.wait()
+        return True
+
+    def notify(self, n=1):
+        if self.lock.owner is not sched.current:
+            raise RuntimeError("notify() without holding the lock")
+        self._wake(n)
+
+    def _wake(self, n):
+        for _ in range(min(n, len(self.waiting))):
+            task = self.waiting.popleft()
+            self.notified.add(task)
+            sched.wake(task)
+
+    def notify_all(self):
+        self.notify(len(self.waiting))
+
+
+# -------------- demo: a bank account with a Condition, and a connection limit with a Semaphore
+
+
+async def deposit(account, cond, amount):
+    async with cond:
+        account[0] += amount
+        cond.notify_all()
+
+
+async def withdraw(account, cond, amount, name):
+    async with cond:
+        await cond.wait_for(lambda: account[0] >= amount)
+        account[0] -= amount
+        print("%s withdrew %d, %d left" % (name, amount, account[0]))
+
+
+async def download(n, limit, running):
+    async with limit:
+        running[0] += 1
+        running[1] = max(running[1], running[0])
+        await sched.sleep(0.01)
+        running[0] -= 1
+
+
+# -------------- benchmark: N tasks fight for one lock
+
+
+async def fair_worker(lock, rounds, counter):
+    for _ in range(rounds):
+        async with lock:
+            counter[0] += 1
+            await switch()  # give the others a chance to pile up behind the lock
+
+
+class SpinLock:
+    # the naive lock: waiting tasks keep checking, so every release makes EVERY waiter run once
+    def __init__(self):
+        self.locked = False
+
+    async def acquire(self):
+        while self.locked:
+            await switch()
+        self.locked = True
+
+    def release(self):
+        self.locked = False
+
+
+async def spin_worker(lock, rounds, counter):
+    for _ in range(rounds):
+        await lock.acquire()
+        counter[0] += 1
+        await switch()
+        lock.release()
+
+
+async def contention(tasks, lock, worker, rounds=5):
+    counter = [0]
+    start = time.perf_counter()
+    for task in [sched.new_task(worker(lock, rounds, counter)) for _ in range(tasks)]:
+        await task
+    elapsed = time.perf_counter() - start
+    assert counter[0] == tasks * rounds
+    return elapsed / counter[0] * 10**6
+
+
+async def main():
+    account = [0]
+    cond = Condition()
+    for name, amount in (("alice", 50), ("bob", 20), ("carol", 80)):
+        sched.new_task(withdraw(account, cond, amount, name))
+    for amount in (10, 30, 40, 70):
+        await sched.sleep(0.01)
+        await deposit(account, cond, amount)
+
+    running = [0, 0]
+    limit = BoundedSemaphore(3)
+    for task in [sched.new_task(download(n, limit, running)) for n in range(10)]:
+        await task
+    print("10 downloads, at most %d at the same time" % running[1])
+
+    ready = Event()
+    waiters = [sched.new_task(ready.wait()) for _ in range(10000)]
+    await switch()
+    start = time.perf_counter()
+    ready.set()
+    for task in waiters:
+        await task
+    print("Event.set() woke up 10000 tasks in %.1f ms" % ((time.perf_counter() - start) * 1000))
+
+    print("time per acquire/release with N tasks waiting for the lock:")
+    for tasks in (100, 1000, 10000, 100000):
+        fair = await contention(tasks, Lock(), fair_worker)
+        if tasks <= 1000:
+            spin = "%8.2f us" % await contention(tasks, SpinLock(), spin_worker)
+        else:
+            spin = "too slow"
+        print("N = %6d   Lock %6.2f us   SpinLock %s" % (tasks, fair, spin))
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,613 @@
+# changes: Broadcast, one producer and many subscribers sharing ONE ring buffer
+#
+# to send every item to 100 consumers with AsyncQueue, you need 100 queues and 100 puts per item
+# a Broadcast channel stores each item once, in a list used as a ring buffer (slot = sequence % capacity)
+# every subscriber has its own cursor: the sequence number of the next item it will read
+# publishing is O(1), and waking the subscribers that wait for the next item is one batch:
+# the whole `waiting` deque goes into the ready queue with ONE extend
+#
+# the ring buffer has a fixed capacity, so what happens when a subscriber falls `capacity` items behind?
+# - "block": the producer waits until the slowest subscriber catches up (backpressure, like AsyncQueue(maxsize))
+# - "drop_oldest": the producer overwrites the oldest items, the slow subscriber skips what it missed
+#   and can see how many items it lost in subscription.dropped
+# - "disconnect": the slow subscriber is thrown out, its next get() raises Disconnected
+# "block" and "disconnect" need the cursor of the slowest subscriber: finding it is O(subscribers),
+# so it's only done when the buffer looks full
+import heapq
+import selectors
+import time
+import traceback
+import tracemalloc
+from collections import deque
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler24 code as in async24
+
+# -------------- same AsyncQueue code as in async24
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize  # 0 means no limit, like queue.Queue
+        self.waiting = deque()  # getters waiting for an item
+        self.putters = deque()  # putters waiting for a free spot
+        self._closed = False
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        # wake up EVERYBODY: getters drain what is left and then see QueueClosed, putters see it right away
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+        for task in self.putters:
+            sched.wake(task)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+        if self.waiting:
+            sched.wake(self.waiting.popleft())
+
+    async def put(self, item):
+        while self.full() and not self._closed:
+            # no room: disappear until a getter makes some
+            self.putters.append(sched.current)
+            sched.current.waiting_on = self.putters
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # a getter may have woken us up for a free spot just before we were cancelled: pass it on
+                if self.putters and not self.full():
+                    sched.wake(self.putters.popleft())
+                raise
+        self.put_nowait(item)
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current.waiting_on = self.waiting
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # same thing: don't take the wake up for this item to the grave
+                if self.waiting and self.items:
+                    sched.wake(self.waiting.popleft())
+                raise
+        item = self.items.popleft()
+        if self.putters:
+            # we just made room for one more item
+            sched.wake(self.putters.popleft())
+        return item
+
+
+# -------------- same AsyncQueue code as in async24
+
+
+class ChannelClosed(Exception):
+    pass
+
+
+class Disconnected(Exception):
+    pass
+
+
+class Broadcast:
+    POLICIES = ("block", "drop_oldest", "disconnect")
+
+    def __init__(self, capacity=1024, policy="block"):
+        if policy not in self.POLICIES:
+            raise ValueError("policy must be one of %r" % (self.POLICIES,))
+        self.buffer = [None] * capacity
+        self.capacity = capacity
+        self.policy = policy
+        self.head = 0  # sequence number of the next item
+        # the cursor of the slowest subscriber, and how many subscribers are there
+        # when the last of them moves on, the next slowest has to be found: O(subscribers), but only then
+        # (if they all read at the same speed, that's once every `subscribers` reads)
+        self.tail = 0
+        self.at_tail = 0
+        self.subscribers = set()
+        self.waiting = deque()  # subscribers that have read everything
+        self.putters = deque()  # with "block": the producer, waiting for the slowest subscriber
+        self._closed = False
+
+    def subscribe(self):
+        # a new subscriber only sees what is published from now on
+        subscription = Subscription(self)
+        self.subscribers.add(subscription)
+        if len(self.subscribers) == 1:
+            self._find_tail()
+        elif self.tail == self.head:
+            self.at_tail += 1
+        return subscription
+
+    def _find_tail(self):
+        if self.subscribers:
+            self.tail = min(subscription.cursor for subscription in self.subscribers)
+            self.at_tail = sum(1 for subscription in self.subscribers if subscription.cursor == self.tail)
+        else:
+            self.tail = self.head
+            self.at_tail = 0
+        if self.putters and self.head - self.tail <= self.capacity // 2:
+            # don't wake the producers for every free slot: let them publish half a buffer in one go
+            for task in self.putters:
+                sched.wake(task)
+            self.putters.clear()
+
+    def _left_tail(self, cursor):
+        # a subscriber moved away from `cursor`: by reading, or by unsubscribing
+        if cursor == self.tail and self.policy != "drop_oldest":
+            self.at_tail -= 1
+            if not self.at_tail:
+                self._find_tail()
+
+    async def publish(self, item):
+        if self._closed:
+            raise ChannelClosed()
+        if not self.subscribers:
+            # nobody will ever read what gets overwritten: nothing to wait for
+            self.tail = self.head
+        if self.head - self.tail >= self.capacity:
+            if self.policy == "block":
+                while self.head - self.tail >= self.capacity:
+                    self.putters.append(sched.current)
+                    sched.current.waiting_on = self.putters
+                    sched.current = None
+                    await switch()
+                    if self._closed:
+                        raise ChannelClosed()
+            elif self.policy == "disconnect":
+                # the slowest subscribers are exactly `capacity` behind: the next item would overwrite theirs
+                for subscription in [s for s in self.subscribers if s.cursor == self.tail]:
+                    subscription.disconnected = True
+                    self.subscribers.discard(subscription)
+                self._find_tail()
+            # with "drop_oldest", just overwrite: subscribers notice that they fell behind in get()
+        self.buffer[self.head % self.capacity] = item
+        self.head += 1
+        if self.waiting:
+            # every subscriber that waits for this item, in one batch
+            waiting = self.waiting
+            self.waiting = deque()
+            for task in waiting:
+                task.waiting_on = None
+            sched.ready.extend(waiting)
+
+    def close(self):
+        self._closed = True
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+        for task in self.putters:
+            sched.wake(task)
+        self.putters.clear()
+
+
+class Subscription:
+    __slots__ = ("channel", "cursor", "dropped", "disconnected")
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.cursor = channel.head
+        self.dropped = 0
+        self.disconnected = False
+
+    async def get(self):
+        channel = self.channel
+        while self.cursor == channel.head:
+            if self.disconnected:
+                raise Disconnected()
+            if channel._closed:
+                raise ChannelClosed()
+            channel.waiting.append(sched.current)
+            sched.current.waiting_on = channel.waiting
+            sched.current = None
+            await switch()
+        if self.disconnected:
+            raise Disconnected()
+        behind = channel.head - self.cursor
+        if behind > channel.capacity:
+            # "drop_oldest" overwrote what we didn't read yet: skip to the oldest item that is still there
+            self.dropped += behind - channel.capacity
+            self.cursor = channel.head - channel.capacity
+        cursor = self.cursor
+        self.cursor = cursor + 1
+        if cursor == channel.tail:
+            channel._left_tail(cursor)
+        return channel.buffer[cursor % channel.capacity]
+
+    def close(self):
+        if self in self.channel.subscribers:
+            self.channel.subscribers.discard(self)
+            self.channel._left_tail(self.cursor)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except ChannelClosed:
+            raise StopAsyncIteration
+
+
+# -------------- demo
+
+
+async def reader(subscription, counts, delay=0):
+    try:
+        async for item in subscription:
+            counts[0] += 1
+            if delay:
+                await sched.sleep(delay)
+    except Disconnected:
+        counts[1] = True
+
+
+async def queue_reader(q, counts):
+    try:
+        while True:
+            await q.get()
+            counts[0] += 1
+    except QueueClosed:
+        pass
+
+
+async def fan_out_queues(subscribers, items):
+    queues = [AsyncQueue(maxsize=1024) for _ in range(subscribers)]
+    counts = [[0, False] for _ in range(subscribers)]
+    tasks = [sched.new_task(queue_reader(q, c)) for q, c in zip(queues, counts)]
+    for item in range(items):
+        for q in queues:
+            await q.put(item)
+    for q in queues:
+        q.close()
+    for task in tasks:
+        await task
+    return sum(c[0] for c in counts)
+
+
+async def fan_out_broadcast(subscribers, items):
+    channel = Broadcast(capacity=1024)
+    counts = [[0, False] for _ in range(subscribers)]
+    tasks = [sched.new_task(reader(channel.subscribe(), c)) for c in counts]
+    for item in range(items):
+        await channel.publish(item)
+    channel.close()
+    for task in tasks:
+        await task
+    return sum(c[0] for c in counts)
+
+
+async def slow_subscriber(policy):
+    channel = Broadcast(capacity=16, policy=policy)
+    fast = [0, False]
+    slow = [0, False]
+    fast_task = sched.new_task(reader(channel.subscribe(), fast))
+    slow_subscription = channel.subscribe()
+    slow_task = sched.new_task(reader(slow_subscription, slow, delay=0.001))
+    start = time.monotonic()
+    for item in range(500):
+        await channel.publish(item)
+        await switch()
+    elapsed = time.monotonic() - start
+    channel.close()
+    await fast_task
+    await slow_task
+    print(
+        "%-12s producer %.2f s | fast subscriber got %d | slow subscriber got %d, dropped %d%s"
+        % (policy, elapsed, fast[0], slow[0], slow_subscription.dropped, ", disconnected" if slow[1] else "")
+    )
+
+
+async def main():
+    items = 5000
+    for subscribers in (10, 100):
+        for name, fan_out in (("AsyncQueues", fan_out_queues), ("Broadcast", fan_out_broadcast)):
+            start = time.perf_counter()
+            received = await fan_out(subscribers, items)
+            elapsed = time.perf_counter() - start
+            assert received == subscribers * items
+            # tracemalloc slows everything down: measure the memory in a second run
+            tracemalloc.start()
+            await fan_out(subscribers, items)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                "%3d subscribers, %-11s %8.0f deliveries/s  peak memory %6d KB"
+                % (subscribers, name, received / elapsed, peak // 1024)
+            )
+
+    print("one slow subscriber, 500 items, capacity 16:")
+    for policy in Broadcast.POLICIES:
+        await slow_subscriber(policy)
+
+
+sched.new_task(main())
+sched.run()
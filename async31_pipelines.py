@@ -0,0 +1,645 @@
+# changes: Pipeline, chain map/filter/batch/window/merge stages over async iterators
+#
+# async10's consumer() is a while loop around q.get(), and every consumer is a new hand-written loop
+# a pipeline says WHAT to do with the items, the stages take care of the loops, the queues and the tasks:
+#
+#   async for batch in Pipeline(urls).map(fetch, workers=16).filter(ok).batch(100, max_wait=0.05):
+#       save(batch)
+#
+# every stage is an async generator that reads the stage before it (async for) and yields its results
+# - filter and window run inside the task that reads the pipeline: no tasks, no queues, no overhead
+# - map(func, workers=N) runs func in N worker tasks. results come out in the order they are done,
+#   not in the order the items went in
+# - merge(*sources) reads several sources at the same time, each in its own task
+# - batch(n, max_wait) collects up to n items, but doesn't hold back a partial batch longer than max_wait
+# between a stage and its worker tasks there's an AsyncQueue(maxsize=buffer): a fast stage waits for a
+# slow one (backpressure), so an endless source never piles up in memory. the reader PULLS the items
+import heapq
+import itertools
+import selectors
+import time
+import traceback
+import tracemalloc
+from collections import deque
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    def __init__(self, maxsize=0):
+        self.items = deque()
+        self.maxsize = maxsize  # 0 means no limit, like queue.Queue
+        self.waiting = deque()  # getters waiting for an item
+        self.putters = deque()  # putters waiting for a free spot
+        self._closed = False
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        # wake up EVERYBODY: getters drain what is left and then see QueueClosed, putters see it right away
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+        for task in self.putters:
+            sched.wake(task)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self.items.append(item)
+        if self.waiting:
+            sched.wake(self.waiting.popleft())
+
+    async def put(self, item):
+        while self.full() and not self._closed:
+            # no room: disappear until a getter makes some
+            self.putters.append(sched.current)
+            sched.current.waiting_on = self.putters
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # a getter may have woken us up for a free spot just before we were cancelled: pass it on
+                if self.putters and not self.full():
+                    sched.wake(self.putters.popleft())
+                raise
+        self.put_nowait(item)
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current.waiting_on = self.waiting
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # same thing: don't take the wake up for this item to the grave
+                if self.waiting and self.items:
+                    sched.wake(self.waiting.popleft())
+                raise
+        item = self.items.popleft()
+        if self.putters:
+            # we just made room for one more item
+            sched.wake(self.putters.popleft())
+        return item
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+async def _iterate(iterable):
+    for item in iterable:
+        yield item
+
+
+async def _pump(source, q, errors):
+    # copy a source into a queue, in a task of its own
+    try:
+        async for item in source:
+            await q.put(item)
+    except QueueClosed:
+        pass  # the reader went away
+    except Exception as e:
+        errors.append(e)
+
+
+def _cancel_all(tasks):
+    # runs in a `finally:` of an async generator, maybe while it's garbage collected: can't await anything
+    for task in tasks:
+        task.cancel()
+
+
+async def _map(source, func, workers, buffer):
+    if workers == 1:
+        async for item in source:
+            yield await func(item)
+        return
+    inbox = AsyncQueue(maxsize=buffer)
+    outbox = AsyncQueue(maxsize=buffer)
+    errors = []
+    running = [workers]
+
+    async def feed():
+        await _pump(source, inbox, errors)
+        inbox.close()
+
+    async def work():
+        try:
+            while True:
+                item = await inbox.get()
+                await outbox.put(await func(item))
+        except QueueClosed:
+            pass
+        except Exception as e:
+            errors.append(e)
+            outbox.close()
+        finally:
+            running[0] -= 1
+            if not running[0]:
+                outbox.close()  # the last worker turns off the lights
+
+    tasks = [sched.new_task(feed())] + [sched.new_task(work()) for _ in range(workers)]
+    try:
+        while True:
+            try:
+                item = await outbox.get()
+            except QueueClosed:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        _cancel_all(tasks)
+
+
+async def _filter(source, predicate):
+    async for item in source:
+        if predicate(item):
+            yield item
+
+
+async def _batch(source, n, max_wait, buffer):
+    if max_wait is None:
+        batch = []
+        async for item in source:
+            batch.append(item)
+            if len(batch) == n:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+    # to stop waiting after max_wait, the items have to come from a queue
+    # one timer per batch, not per item: when it expires while we wait for an item, it takes us out of q.waiting
+    q = AsyncQueue(maxsize=buffer)
+    errors = []
+    due = False
+
+    def expire(task):
+        nonlocal due
+        due = True
+        if task.waiting_on is q.waiting:
+            q.waiting.remove(task)
+            sched.wake(task)
+
+    async def feed():
+        await _pump(source, q, errors)
+        q.close()
+
+    tasks = [sched.new_task(feed())]
+    try:
+        while True:
+            try:
+                batch = [await q.get()]
+            except QueueClosed:
+                break
+            due = False
+            handle = sched.call_later(max_wait, expire, sched.current)
+            try:
+                while len(batch) < n:
+                    if not q.empty():
+                        batch.append(await q.get())  # doesn't wait
+                    elif due or q._closed:
+                        break
+                    else:
+                        # what q.get() does, except that expire() can wake us up too
+                        q.waiting.append(sched.current)
+                        sched.current.waiting_on = q.waiting
+                        sched.current = None
+                        await switch()
+            finally:
+                handle.cancel()
+            yield batch
+        if errors:
+            raise errors[0]
+    finally:
+        _cancel_all(tasks)
+
+
+async def _window(source, size, step):
+    # sliding windows: the last `size` items, every `step` items (step=size: windows that don't overlap)
+    window = deque(maxlen=size)
+    count = 0
+    async for item in source:
+        window.append(item)
+        count += 1
+        if count >= size and (count - size) % step == 0:
+            yield tuple(window)
+
+
+async def _merge(sources, buffer):
+    q = AsyncQueue(maxsize=buffer)
+    errors = []
+    running = [len(sources)]
+
+    async def feed(source):
+        await _pump(source, q, errors)
+        running[0] -= 1
+        if not running[0]:
+            q.close()
+
+    tasks = [sched.new_task(feed(source)) for source in sources]
+    try:
+        while True:
+            try:
+                item = await q.get()
+            except QueueClosed:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        _cancel_all(tasks)
+
+
+async def _take(source, n):
+    if n <= 0:
+        return
+    count = 0
+    try:
+        async for item in source:
+            yield item
+            count += 1
+            if count == n:
+                break
+    finally:
+        aclose = getattr(source, "aclose", None)  # async generators have one, any async iterable doesn't
+        if aclose is not None:
+            await aclose()  # stop the stages before us now, not when they're garbage collected
+
+
+class Pipeline:
+    def __init__(self, source):
+        # an async iterable, or a plain iterable (a list, a generator, ...)
+        self.source = source if hasattr(source, "__aiter__") else _iterate(source)
+
+    def __aiter__(self):
+        return self.source.__aiter__()
+
+    def map(self, func, workers=1, buffer=16):
+        return Pipeline(_map(self.source, func, workers, buffer))
+
+    def filter(self, predicate):
+        return Pipeline(_filter(self.source, predicate))
+
+    def batch(self, n, max_wait=None, buffer=16):
+        return Pipeline(_batch(self.source, n, max_wait, buffer))
+
+    def window(self, size, step=1):
+        return Pipeline(_window(self.source, size, step))
+
+    def take(self, n):
+        return Pipeline(_take(self.source, n))
+
+    @staticmethod
+    def merge(*sources, buffer=16):
+        return Pipeline(_merge([Pipeline(source).source for source in sources], buffer))
+
+    async def collect(self):
+        return [item async for item in self]
+
+
+# -------------- demo
+
+
+async def square(x):
+    await sched.sleep(0.01)
+    return x * x
+
+
+async def ticker(name, interval, count):
+    for n in range(count):
+        await sched.sleep(interval)
+        yield "%s%d" % (name, n)
+
+
+async def fake_io(x):
+    await sched.sleep(0.001)  # a 1 ms request to some server
+    return x
+
+
+async def average(window):
+    return sum(window) / len(window)
+
+
+async def throughput(workers, items=2000):
+    start = time.perf_counter()
+    count = len(await Pipeline(range(items)).map(fake_io, workers=workers).collect())
+    return count / (time.perf_counter() - start)
+
+
+async def endless(items):
+    # an endless source through 4 stages: memory must not depend on how many items went through
+    pipeline = (
+        Pipeline(itertools.count())
+        .map(fake_io, workers=32, buffer=64)
+        .filter(lambda x: x % 3)
+        .batch(50, max_wait=0.01)
+        .take(items // 75)
+    )
+    tracemalloc.start()
+    async for batch in pipeline:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+async def main():
+    pipeline = Pipeline(range(20)).map(square, workers=4).filter(lambda x: x % 2 == 0).batch(3, max_wait=0.05)
+    async for batch in pipeline:
+        print("batch", batch)
+
+    averages = Pipeline([1, 5, 3, 8, 2, 9, 4]).window(3).map(average)
+    print("moving averages:", await averages.collect())
+
+    print("merged:", await Pipeline.merge(ticker("a", 0.01, 5), ticker("b", 0.025, 3)).collect())
+
+    for workers in (1, 4, 16, 64):
+        print("map with %2d workers: %6.0f items/s" % (workers, await throughput(workers)))
+
+    for items in (10**4, 10**5):
+        print("endless source, %6d items: tracemalloc peak %d KB" % (items, await endless(items) // 1024))
+
+
+sched.new_task(main())
+sched.run()
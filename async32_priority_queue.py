@@ -0,0 +1,483 @@
+# changes: PriorityAsyncQueue and LifoAsyncQueue
+#
+# AsyncQueue is FIFO: an urgent message put behind 100 bulk messages waits for all 100 of them
+# async3 already showed the trick for timers: a heapq of (key, sequence, item)
+# - the heap always pops the smallest key first: priority 0 before priority 1 before priority 2, ...
+# - the sequence number breaks ties: two items with the same priority come out in the order they went in
+#   (and the items themselves are never compared, so they don't have to be comparable)
+#
+# like queue.Queue and queue.PriorityQueue, AsyncQueue now keeps its items behind 3 small methods,
+# _init, _put and _get, and the variants only replace those. waiting, maxsize and close() don't change
+import heapq
+import itertools
+import selectors
+import time
+import traceback
+from collections import deque
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler24:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+
+sched = Scheduler24()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AsyncQueue:
+    def __init__(self, maxsize=0):
+        self._init()
+        self.maxsize = maxsize  # 0 means no limit, like queue.Queue
+        self.waiting = deque()  # getters waiting for an item
+        self.putters = deque()  # putters waiting for a free spot
+        self._closed = False
+
+    # the only 3 methods that know how the items are stored
+
+    def _init(self):
+        self.items = deque()
+
+    def _put(self, item):
+        self.items.append(item)
+
+    def _get(self):
+        return self.items.popleft()
+
+    # -------------- same AsyncQueue code as in async24, except _wait_for_room(), _put() and _get()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def close(self):
+        self._closed = True
+        # wake up EVERYBODY: getters drain what is left and then see QueueClosed, putters see it right away
+        for task in self.waiting:
+            sched.wake(task)
+        self.waiting.clear()
+        for task in self.putters:
+            sched.wake(task)
+        self.putters.clear()
+
+    def put_nowait(self, item):
+        if self._closed:
+            raise QueueClosed()
+        if self.full():
+            raise QueueFull()
+        self._put(item)
+        if self.waiting:
+            sched.wake(self.waiting.popleft())
+
+    async def put(self, item):
+        await self._wait_for_room()
+        self.put_nowait(item)
+
+    async def _wait_for_room(self):
+        while self.full() and not self._closed:
+            # no room: disappear until a getter makes some
+            self.putters.append(sched.current)
+            sched.current.waiting_on = self.putters
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # a getter may have woken us up for a free spot just before we were cancelled: pass it on
+                if self.putters and not self.full():
+                    sched.wake(self.putters.popleft())
+                raise
+
+    async def get(self):
+        while not self.items:
+            if self._closed:
+                raise QueueClosed()
+            self.waiting.append(sched.current)
+            sched.current.waiting_on = self.waiting
+            sched.current = None
+            try:
+                await switch()
+            except Cancelled:
+                # same thing: don't take the wake up for this item to the grave
+                if self.waiting and self.items:
+                    sched.wake(self.waiting.popleft())
+                raise
+        item = self._get()
+        if self.putters:
+            # we just made room for one more item
+            sched.wake(self.putters.popleft())
+        return item
+
+    # -------------- same AsyncQueue code as in async24, except _wait_for_room(), _put() and _get()
+
+
+class PriorityAsyncQueue(AsyncQueue):
+    # q.put_nowait(item, priority) / await q.put(item, priority): the lowest priority comes out first
+
+    def _init(self):
+        self.items = []  # a heap of (priority, sequence, item)
+        self.sequence = itertools.count()
+
+    def _put(self, entry):
+        heapq.heappush(self.items, entry)
+
+    def _get(self):
+        return heapq.heappop(self.items)[2]
+
+    def put_nowait(self, item, priority=0):
+        super().put_nowait((priority, next(self.sequence), item))
+
+    async def put(self, item, priority=0):
+        await self._wait_for_room()
+        self.put_nowait(item, priority)
+
+
+class LifoAsyncQueue(AsyncQueue):
+    # a stack: the item put last comes out first
+
+    def _get(self):
+        return self.items.pop()
+
+
+# -------------- demo: a worker with a backlog of bulk jobs, and a few urgent ones
+
+
+async def worker(q, latencies):
+    try:
+        while True:
+            kind, submitted = await q.get()
+            await sched.sleep(0.0005)  # the job itself
+            if kind == "urgent":
+                latencies.append(time.monotonic() - submitted)
+    except QueueClosed:
+        pass
+
+
+async def put(q, item, priority):
+    if isinstance(q, PriorityAsyncQueue):
+        await q.put(item, priority)
+    else:
+        await q.put(item)
+
+
+async def bulk_producer(q, count):
+    waited = 0
+    for _ in range(count):
+        if q.full():
+            waited += 1  # put() is going to park until the worker makes room
+        await put(q, ("bulk", time.monotonic()), 1)
+    return waited
+
+
+async def urgent_producer(q, count):
+    for _ in range(count):
+        await sched.sleep(0.01)
+        await put(q, ("urgent", time.monotonic()), 0)
+
+
+async def backlog(q):
+    latencies = []
+    worker_task = sched.new_task(worker(q, latencies))
+    bulk = sched.new_task(bulk_producer(q, 500))
+    await sched.new_task(urgent_producer(q, 10))
+    waited = await bulk
+    q.close()
+    await worker_task
+    print(
+        "%-18s urgent jobs waited %5.1f ms on average, %5.1f ms at most, bulk producer waited %d times"
+        % (type(q).__name__, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000, waited)
+    )
+
+
+async def main():
+    q = PriorityAsyncQueue()
+    for item, priority in (("low", 2), ("high 1", 0), ("normal", 1), ("high 2", 0), ("high 3", 0)):
+        q.put_nowait(item, priority)
+    print("priority order:", [await q.get() for _ in range(q.qsize())])
+
+    stack = LifoAsyncQueue()
+    for item in range(5):
+        stack.put_nowait(item)
+    stack.close()
+    print("lifo order:", [await stack.get() for _ in range(stack.qsize())])
+
+    # a getter that waits is woken up by the put, like with AsyncQueue
+    getter = sched.new_task(q.get())
+    await switch()
+    q.put_nowait("finally something", 5)
+    print("waiting getter got:", await getter)
+
+    # with maxsize, the bulk producer can't run away: 500 jobs, but never more than 100 in the queue
+    # that's backpressure, no matter the priority
+    for q in (AsyncQueue(maxsize=100), PriorityAsyncQueue(maxsize=100)):
+        await backlog(q)
+
+
+sched.new_task(main())
+sched.run()
@@ -0,0 +1,380 @@
+# changes: Scheduler33(eager=True) and new_task(coro, eager=True)
+#
+# new_task only puts the task in the ready queue: the coroutine doesn't start until the scheduler gets to it
+# a coroutine that never suspends (a cache hit, a queue that already has an item, ...) still pays for
+# - a trip through the ready queue, behind every other ready task
+# - the parent parking in task.__await__ and being woken up again when the task is done
+#
+# eager tasks start running INSIDE new_task, until they park for the first time (or switch(), or finish)
+# - a task that finishes right away is already done when new_task returns it: awaiting it doesn't park
+# - a task that parks is in the selector, a timer, a queue, ... just like any other parked task
+# - a task that calls switch() goes to the ready queue like before
+#
+# the catch: the order changes. with eager tasks the child runs BEFORE the code after new_task
+# and an eager task that spawns eager tasks nests them on the Python stack
+# that's why it's opt-in, for the whole scheduler or per task
+# (asyncio has the same thing since Python 3.12: asyncio.eager_task_factory)
+import gc
+import heapq
+import random
+import selectors
+import time
+import traceback
+from collections import deque
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Task:
+    __slots__ = ("coro", "done", "result", "exception", "waiters", "retrieved", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.waiters = None  # most tasks are never awaited, so don't create a list for them
+        self.retrieved = False
+        self.waiting_on = None  # the deque, list, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __await__(self):
+        if not self.done:
+            if self.waiters is None:
+                self.waiters = []
+            self.waiters.append(sched.current)
+            sched.current.waiting_on = self.waiters
+            sched.current = None  # disappear until this task is done
+            yield
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def _finish(self, result, exception, ready):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.coro = None
+        if self.waiters:
+            for waiter in self.waiters:
+                waiter.waiting_on = None
+                ready.append(waiter)
+            self.waiters = None
+
+    def __del__(self):
+        # nobody awaited a task that crashed: at least tell somebody about it
+        # (a cancelled task didn't crash, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("Task exception was never retrieved:")
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+class Scheduler33:
+    def __init__(self, compact_ratio=0.5, eager=False):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+        self.eager = eager
+
+    def new_task(self, coro, eager=None):
+        task = Task(coro)
+        if not (self.eager if eager is None else eager):
+            self.ready.append(task)
+            return task
+        # eager: run the coroutine RIGHT NOW, until it finishes or parks for the first time,
+        # then give the scheduler back to the task that called new_task
+        # it's the same step as in run(), minus the cancellation (nobody could cancel this task yet)
+        parent = self.current
+        self.current = task
+        try:
+            coro.send(None)
+        except StopIteration as e:
+            task._finish(e.value, None, self.ready)
+        except (Exception, Cancelled) as e:
+            task._finish(None, e, self.ready)
+        else:
+            if self.current:
+                # switch(): the task gave up its turn, but it still wants to run
+                self.ready.append(task)
+        finally:
+            self.current = parent
+        return task
+
+    # -------------- same Scheduler24 code as in async24
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                handle.callback(*handle.args)
+
+            for _ in range(len(ready)):
+                task = self.current = ready.popleft()
+                try:
+                    if task.cancelling:
+                        task.cancelling = False
+                        task.coro.throw(Cancelled())
+                    else:
+                        task.coro.send(None)
+                except StopIteration as e:
+                    task._finish(e.value, None, ready)
+                except (Exception, Cancelled) as e:
+                    task._finish(None, e, ready)
+                else:
+                    if self.current:
+                        ready.append(task)
+                    elif task.cancelling and task.waiting_on is not None:
+                        # the task cancelled itself, and then went to sleep anyway
+                        task._unpark()
+        self.current = None
+
+    # -------------- same Scheduler24 code as in async24
+
+
+sched = Scheduler33()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- demo: the order changes
+
+
+async def child(name):
+    print("  %s started" % name)
+    await switch()
+    print("  %s resumed" % name)
+
+
+async def order(eager):
+    print("eager" if eager else "lazy")
+    task = sched.new_task(child("child"), eager=eager)
+    print("  parent after new_task")
+    await task
+
+
+# -------------- benchmark: lots of tasks that (almost) never suspend
+
+
+cache = {}
+
+
+async def lookup(key):
+    if key in cache:
+        return cache[key]
+    await sched.sleep(0.001)  # a cache miss goes to the database
+    cache[key] = value = key * 2
+    return value
+
+
+async def fan_out(keys):
+    tasks = [sched.new_task(lookup(key)) for key in keys]
+    return [await task for task in tasks]
+
+
+def bench(eager, hit_ratio, count=10**5, repeat=5):
+    global sched
+    best = None
+    for _ in range(repeat):
+        random.seed(0)
+        cache.clear()
+        keys = list(range(count))
+        cache.update((key, key * 2) for key in keys if random.random() < hit_ratio)
+        sched = Scheduler33(eager=eager)
+        task = sched.new_task(fan_out(keys), eager=False)
+        gc.collect()  # don't time the garbage of the previous run
+        start = time.perf_counter()
+        sched.run()
+        elapsed = time.perf_counter() - start
+        assert task.result == [key * 2 for key in keys]
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    global sched
+    for eager in (False, True):
+        sched = Scheduler33()
+        sched.new_task(order(eager))
+        sched.run()
+
+    print()
+    print("%d tasks, best of 5:" % 10**5)
+    for hit_ratio in (1.0, 0.99, 0.9, 0.5):
+        lazy = bench(False, hit_ratio)
+        eager = bench(True, hit_ratio)
+        print(
+            "cache hits %3d%%   lazy %6.1f ms   eager %6.1f ms   %.2fx"
+            % (hit_ratio * 100, lazy * 1000, eager * 1000, lazy / eager)
+        )
+
+
+main()
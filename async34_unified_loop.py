@@ -0,0 +1,552 @@
+# changes: ONE ready queue for callbacks and tasks, and a Future to go from one to the other
+#
+# Scheduler3 runs callbacks: cheap, but the code turns into callback hell (async4, async5)
+# Scheduler8 and later run coroutines: easy to read, but every step goes through Task and coro.send()
+# they were 2 different engines, so the callback-style AsyncQueue of async5 couldn't be used with `await`
+#
+# now the ready queue holds plain callables:
+# - sched.call_soon(func, *args) puts a callback in it, like Scheduler3
+# - a Task is a callable too: task() runs the coroutine one step, like the inside of the old run() loop
+# - an expired TimerHandle goes in it too, instead of calling its callback right away
+# - run() doesn't know the difference: ready.popleft()()
+#
+# Future is the bridge: a result that isn't there yet
+# - callback code calls fut.set_result(value) / fut.set_exception(exc) when it has one,
+#   and waits for one with fut.add_done_callback(func): func(fut) is called soon after the future is done
+# - a coroutine just does `value = await fut`: the task parks in the future's callbacks
+#   and the task itself is the callback that wakes it up
+# Task is a Future whose result comes from a coroutine, so callbacks can wait for tasks too
+#
+# hot paths (timers, protocol parsers, a queue's internals) can stay cheap callbacks,
+# and the business logic on top of them uses await
+import functools
+import heapq
+import selectors
+import time
+import traceback
+from collections import deque
+
+
+class Cancelled(BaseException):
+    pass
+
+
+class Future:
+    __slots__ = ("done", "result", "exception", "callbacks", "retrieved")
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.callbacks = None  # most futures have a single waiter, if any: don't create a list before that
+        self.retrieved = False
+
+    def set_result(self, result):
+        if self.done:
+            raise RuntimeError("%r is already done" % self)
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        if self.done:
+            raise RuntimeError("%r is already done" % self)
+        self._finish(None, exception)
+
+    def add_done_callback(self, func):
+        # func(future) once the future is done: never right away, always from the ready queue
+        callback = functools.partial(func, self)
+        if self.done:
+            sched.ready.append(callback)
+        else:
+            if self.callbacks is None:
+                self.callbacks = []
+            self.callbacks.append(callback)
+
+    def value(self):
+        # for callbacks: the result, or raise the exception
+        self.retrieved = True
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def __await__(self):
+        if not self.done:
+            # the waiting task is its own callback: calling it runs it
+            if self.callbacks is None:
+                self.callbacks = []
+            self.callbacks.append(sched.current)
+            sched.current.waiting_on = self.callbacks
+            sched.current = None  # disappear until this future is done
+            yield
+        return self.value()
+
+    def _finish(self, result, exception):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        if self.callbacks:
+            ready = sched.ready
+            for callback in self.callbacks:
+                if type(callback) is Task:
+                    callback.waiting_on = None
+                ready.append(callback)
+            self.callbacks = None
+
+    def __del__(self):
+        # nobody looked at a future that failed: at least tell somebody about it
+        # (a cancelled task didn't fail, somebody wanted it to stop)
+        if self.exception is not None and not self.retrieved and not isinstance(self.exception, Cancelled):
+            print("%s exception was never retrieved:" % type(self).__name__)
+            traceback.print_exception(type(self.exception), self.exception, self.exception.__traceback__)
+
+    def __repr__(self):
+        return "<Future %s>" % ("done" if self.done else "pending")
+
+
+class Task(Future):
+    __slots__ = ("coro", "waiting_on", "cancelling")
+
+    def __init__(self, coro):
+        super().__init__()
+        self.coro = coro
+        self.waiting_on = None  # the list, deque, TimerHandle or IOWaiters this task is parked in
+        self.cancelling = False  # throw Cancelled into the coroutine the next time it runs
+
+    def __call__(self):
+        # one step of the coroutine: what the run() loop used to do for every task
+        sched.current = self
+        try:
+            if self.cancelling:
+                self.cancelling = False
+                self.coro.throw(Cancelled())
+            else:
+                self.coro.send(None)
+        except StopIteration as e:
+            self._finish(e.value, None)
+        except (Exception, Cancelled) as e:
+            self._finish(None, e)
+        else:
+            if sched.current:
+                sched.ready.append(self)
+            elif self.cancelling and self.waiting_on is not None:
+                # the task cancelled itself, and then went to sleep anyway
+                self._unpark()
+        sched.current = None
+
+    def _finish(self, result, exception):
+        super()._finish(result, exception)
+        self.coro = None
+
+    # -------------- same Task code as in async24, minus the old _finish
+
+    def cancel(self):
+        if self.done:
+            return False
+        self.cancelling = True
+        if self.waiting_on is not None:
+            self._unpark()
+        # otherwise the task is already in the ready queue, or it is cancelling itself
+        return True
+
+    def _unpark(self):
+        self.waiting_on.remove(self)
+        self.waiting_on = None
+        sched.ready.append(self)
+
+    def __repr__(self):
+        state = "done" if self.done else "cancelling" if self.cancelling else "pending"
+        return "<Task %s %r>" % (state, self.coro)
+
+    # -------------- same Task code as in async24, minus the old _finish
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "scheduler")
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.scheduler is not None:
+            self.scheduler._timer_cancelled()
+            self.scheduler = None
+
+    def remove(self, task):
+        # the task sleeping on this timer was cancelled: the timer has nothing left to do
+        self.cancel()
+
+    def __call__(self):
+        # an expired timer waits in the ready queue: it can still be cancelled until it gets there
+        # (a task that sleeps and is cancelled in between must not be woken up twice)
+        if not self.cancelled:
+            self.callback(*self.args)
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+class IOWaiters(list):
+    # key.data of a watched socket: [reader, writer] like before,
+    # plus what it takes to stop watching the socket when a waiting task is cancelled
+    __slots__ = ("selector", "fileobj")
+
+    def __init__(self, selector, fileobj):
+        super().__init__((None, None))
+        self.selector = selector
+        self.fileobj = fileobj
+
+    def events(self):
+        events = 0
+        if self[0] is not None:
+            events |= selectors.EVENT_READ
+        if self[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def update(self):
+        events = self.events()
+        if events:
+            self.selector.modify(self.fileobj, events, self)
+        else:
+            self.selector.unregister(self.fileobj)
+
+    def remove(self, task):
+        self[self.index(task)] = None
+        self.update()
+
+
+# -------------- same Scheduler24 code as in async24
+
+
+class Scheduler34:
+    def __init__(self, compact_ratio=0.5):
+        self.ready = deque()  # callbacks AND tasks: anything that can be called without arguments
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.compact_ratio = compact_ratio
+        self.cancelled_timers = 0
+
+    def call_soon(self, func, *args):
+        self.ready.append(functools.partial(func, *args) if args else func)
+
+    def new_task(self, coro):
+        task = Task(coro)
+        self.ready.append(task)
+        return task
+
+    # -------------- same Scheduler24 code as in async24
+
+    def wake(self, task):
+        # the ONLY way back from wherever a task was parked
+        task.waiting_on = None
+        self.ready.append(task)
+
+    def call_later(self, delay, func, *args):
+        handle = TimerHandle(time.monotonic() + delay, func, args, self)
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (handle.deadline, self.sequence, handle))
+        return handle
+
+    async def sleep(self, delay):
+        self.current.waiting_on = self.call_later(delay, self.wake, self.current)
+        self.current = None
+        await switch()
+
+    def _timer_cancelled(self):
+        self.cancelled_timers += 1
+        if (
+            self.compact_ratio is not None
+            and self.cancelled_timers > 64
+            and self.cancelled_timers > len(self.sleeping) * self.compact_ratio
+        ):
+            self.sleeping[:] = [entry for entry in self.sleeping if not entry[2].cancelled]
+            heapq.heapify(self.sleeping)
+            self.cancelled_timers = 0
+
+    def _wait_io(self, fileobj, event):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            waiters = IOWaiters(self.selector, fileobj)
+            waiters[event - 1] = self.current
+            self.selector.register(fileobj, event, waiters)
+        else:
+            waiters = key.data
+            if waiters[event - 1] is not None:
+                raise RuntimeError("another task is already waiting on this socket")
+            waiters[event - 1] = self.current
+            self.selector.modify(fileobj, key.events | event, waiters)
+        self.current.waiting_on = waiters
+        self.current = None
+
+    async def wait_readable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_READ)
+        await switch()
+
+    async def wait_writable(self, fileobj):
+        self._wait_io(fileobj, selectors.EVENT_WRITE)
+        await switch()
+
+    def _poll(self, timeout):
+        if not self.selector.get_map():
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            waiters = key.data
+            if events & selectors.EVENT_READ:
+                self.wake(waiters[0])
+                waiters[0] = None
+            if events & selectors.EVENT_WRITE:
+                self.wake(waiters[1])
+                waiters[1] = None
+            waiters.update()
+
+    # -------------- same Scheduler24 code as in async24
+
+    def run(self):
+        ready = self.ready
+        sleeping = self.sleeping
+        while ready or len(sleeping) > self.cancelled_timers or self.selector.get_map():
+            while sleeping and sleeping[0][2].cancelled:
+                heapq.heappop(sleeping)
+                self.cancelled_timers -= 1
+            if ready:
+                timeout = 0
+            elif sleeping:
+                timeout = max(0, sleeping[0][0] - time.monotonic())
+            else:
+                timeout = None
+            self._poll(timeout)
+
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                handle = heapq.heappop(sleeping)[2]
+                if handle.cancelled:
+                    self.cancelled_timers -= 1
+                    continue
+                handle.scheduler = None
+                # through the ready queue like every other callback: one that raises can't stop the loop
+                ready.append(handle)
+
+            for _ in range(len(ready)):
+                callback = ready.popleft()
+                try:
+                    callback()
+                except Exception:
+                    # a broken callback must not take the whole scheduler down (tasks catch their own)
+                    print("Exception in callback %r:" % callback)
+                    traceback.print_exc()
+
+
+sched = Scheduler34()
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- the callback-style AsyncQueue of async5, with `await` on top
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class Result:
+    def __init__(self, value=None, exc=None):
+        self.value = value
+        self.exc = exc
+
+    def result(self):
+        if self.exc:
+            raise self.exc
+        else:
+            return self.value
+
+
+class AsyncQueue:
+    def __init__(self):
+        self.items = deque()
+        self.waiting = deque()  # all getters waiting for data
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        if self.waiting and not self.items:
+            # let getters know of close
+            for func in self.waiting:
+                sched.call_soon(func)
+
+    def put(self, item):
+        if self._closed:
+            raise QueueClosed()
+        self.items.append(item)
+        if self.waiting:
+            func = self.waiting.popleft()
+            # do we call getter right away here?
+            # func(item)
+            # or do we schedule it to call later?
+            # it's best to schedule it in case the getter is slow/nested/complicated
+            sched.call_soon(func)
+
+    def get(self, callback):
+        # you can call get() until the queue is empty even if the queue is closed
+
+        ### how to wait until an item is ready?
+        # very weird
+        # one way is to pass a callback to get()
+        # callback is called once the item is ready
+        if self.items:
+            # return a good result
+            callback(Result(value=self.items.popleft()))
+        else:
+            if self._closed:
+                # raise exception
+                callback(Result(exc=QueueClosed()))
+            else:
+                # if no data available, then put the getter into a list and call it eventually
+                self.waiting.append(lambda: self.get(callback))
+
+
+def queue_get(q):
+    # the bridge: q.get() wants a callback, a coroutine wants something to await
+    fut = Future()
+
+    def on_item(result):
+        try:
+            fut.set_result(result.result())
+        except QueueClosed as e:
+            fut.set_exception(e)
+
+    q.get(on_item)
+    return fut
+
+
+def producer(q, count):
+    # callback style, straight from async5
+    def _run(n):
+        if n < count:
+            print("producing", n)
+            q.put(n)
+            sched.call_later(0.1, _run, n + 1)
+        else:
+            print("producer done")
+            q.close()
+
+    _run(0)
+
+
+async def consumer(q):
+    # coroutine style, on the SAME queue
+    total = 0
+    try:
+        while True:
+            item = await queue_get(q)
+            print("consuming", item)
+            total += item
+    except QueueClosed:
+        print("consumer done")
+    return total
+
+
+# -------------- a timer that expired is still in the ready queue when its task is cancelled
+
+
+async def sleeper():
+    await sched.sleep(0.05)
+
+
+async def hog():
+    time.sleep(0.1)  # blocks the loop: the timeout below and the sleeper's timer expire in the same round
+
+
+def cancel_after_expiry():
+    task = sched.new_task(sleeper())
+    sched.new_task(hog())
+    sched.call_later(0.04, task.cancel)  # runs first, and finds the task still parked on its (expired) timer
+    sched.run()
+    # cancelled exactly once: the expired timer must not wake the task up a second time
+    assert isinstance(task.exception, Cancelled), task.exception
+    print("cancelled between timer expiry and wake up:", task)
+
+
+# -------------- benchmark: what does one step cost?
+
+
+def bench_callbacks(count):
+    left = count
+
+    def tick():
+        nonlocal left
+        left -= 1
+        if left:
+            sched.call_soon(tick)
+
+    sched.call_soon(tick)
+
+
+def bench_callback_args(count):
+    def tick(n):
+        if n:
+            sched.call_soon(tick, n - 1)  # arguments cost a functools.partial
+
+    sched.call_soon(tick, count)
+
+
+def bench_tasks(count):
+    async def ticks():
+        for _ in range(count):
+            await switch()
+
+    sched.new_task(ticks())
+
+
+def bench_futures(count):
+    async def ticks():
+        for n in range(count):
+            fut = Future()
+            sched.call_soon(fut.set_result, n)
+            await fut
+
+    sched.new_task(ticks())
+
+
+def main():
+    q = AsyncQueue()
+    sched.call_soon(producer, q, 3)
+    task = sched.new_task(consumer(q))
+    # and callback code can wait for a task
+    task.add_done_callback(lambda task: print("consumer task returned", task.value()))
+    sched.run()
+    cancel_after_expiry()
+
+    print()
+    count = 2 * 10**5
+    for name, bench in (
+        ("call_soon(func)", bench_callbacks),
+        ("call_soon(func, n)", bench_callback_args),
+        ("await switch()", bench_tasks),
+        ("await Future", bench_futures),
+    ):
+        bench(count)
+        start = time.perf_counter()
+        sched.run()
+        elapsed = time.perf_counter() - start
+        print("%-20s %6.0f ns per step" % (name, elapsed / count * 1e9))
+
+
+main()
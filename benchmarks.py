@@ -0,0 +1,537 @@
+# a reproducible benchmark suite for the scheduler generations of this tutorial, and for asyncio
+#
+#   python benchmarks.py                      # print JSON results to stdout
+#   python benchmarks.py --output bench.json  # or save them, to compare before/after a change
+#   python benchmarks.py --scale 0.1          # quick run with 10x fewer operations
+#
+# benchmarks:
+#   switch  - two tasks ping-pong through the scheduler (switch(), yield, call_soon, asyncio.sleep(0))
+#   spawn   - create many tasks that finish right away, and run them to completion
+#   timers  - many tasks sleep for a random few milliseconds (call_later for Scheduler3)
+#   queue   - a producer hands items one by one to a consumer through an AsyncQueue
+# a scheduler that can't do something (Scheduler6 and Scheduler7 have no timers) reports null
+#
+# options: --scale (multiply the number of operations), --repeat N (keep the best of N runs, default 3),
+# --only switch timers ... (run only these benchmarks), --output FILE (write the JSON there)
+#
+# the JSON output: where it ran, and for every benchmark and scheduler the best run
+#   {"python": ..., "implementation": ..., "platform": ..., "timestamp": ..., "scale": ..., "repeat": ...,
+#    "results": {"switch": {"Scheduler3": {"ops": 200000, "seconds": 0.16, "ops_per_second": 1250000.0},
+#                           "Scheduler6": {...}, ..., "asyncio": {...}},
+#                "timers": {"Scheduler6": null, ...}, ...}}
+#
+# the schedulers are copied from their files: importing asyncN.py would run its demo
+import argparse
+import asyncio
+import heapq
+import json
+import platform
+import random
+import sys
+import time
+from collections import deque
+
+# -------------- same Scheduler3 code as in async3
+
+
+class Scheduler3:
+    def __init__(self):
+        self.ready = deque()
+        self.sleeping = []
+        self.sequence = 0
+
+    def call_soon(self, func):
+        self.ready.append(func)
+
+    def call_later(self, delay: float, func):
+        self.sequence += 1
+        deadline = time.time() + delay
+        heapq.heappush(self.sleeping, (deadline, self.sequence, func))
+
+    def run(self):
+        while self.ready or self.sleeping:
+            if not self.ready:
+                deadline, _, func = heapq.heappop(self.sleeping)
+                delta = deadline - time.time()
+                if delta > 0:
+                    time.sleep(delta)
+                self.ready.append(func)
+            while self.ready:
+                func = self.ready.popleft()
+                func()
+
+
+# -------------- same Scheduler3 code as in async3
+
+# -------------- same Scheduler6 code as in async6
+
+
+class Scheduler6:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+
+    def new_task(self, gen):
+        self.ready.append(gen)
+
+    def run(self):
+        while self.ready:
+            self.current = self.ready.popleft()
+            try:
+                next(self.current)
+                if self.current:
+                    self.ready.append(self.current)
+            except StopIteration:
+                pass
+
+
+# -------------- same Scheduler6 code as in async6
+
+# -------------- same Scheduler7 code as in async7
+
+
+class Scheduler7:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+
+    def new_task(self, gen):
+        self.ready.append(gen)
+
+    def run(self):
+        while self.ready:
+            self.current = self.ready.popleft()
+            try:
+                self.current.send(None)
+                if self.current:
+                    self.ready.append(self.current)
+            except StopIteration:
+                pass
+
+
+# -------------- same Scheduler7 code as in async7
+
+# -------------- same Scheduler8 code as in async8
+
+
+class Scheduler8:
+    def __init__(self):
+        self.ready = deque()
+        self.current = None
+        self.sleeping = []
+        self.sequence = 0
+
+    def new_task(self, coro):
+        self.ready.append(coro)
+
+    async def sleep(self, delay):
+        deadline = time.time() + delay
+        self.sequence += 1
+        heapq.heappush(self.sleeping, (deadline, self.sequence, self.current))
+        self.current = None
+        await switch()
+
+    def run(self):
+        while self.ready or self.sleeping:
+            if not self.ready:
+                deadline, _, coro = heapq.heappop(self.sleeping)
+                delta = deadline - time.time()
+                if delta > 0:
+                    time.sleep(delta)
+                self.ready.append(coro)
+            self.current = self.ready.popleft()
+            try:
+                self.current.send(None)
+                if self.current:
+                    self.ready.append(self.current)
+            except StopIteration:
+                pass
+
+
+class Awaitable:
+    def __await__(self):
+        yield
+
+
+def switch():
+    return Awaitable()
+
+
+# -------------- same Scheduler8 code as in async8
+
+
+# the queues from async4 and async9, except that they take the scheduler as an argument
+# instead of using the global `sched`, because every benchmark run gets a fresh scheduler
+
+
+class CallbackQueue:
+    # async4: get() takes a callback
+    def __init__(self, sched):
+        self.sched = sched
+        self.items = deque()
+        self.waiting = deque()
+
+    def put(self, item):
+        self.items.append(item)
+        if self.waiting:
+            self.sched.call_soon(self.waiting.popleft())
+
+    def get(self, callback):
+        if self.items:
+            callback(self.items.popleft())
+        else:
+            self.waiting.append(lambda: self.get(callback))
+
+
+class GeneratorQueue:
+    # async9, but with `yield` instead of `await switch()`: use it as `item = yield from q.get()`
+    def __init__(self, sched):
+        self.sched = sched
+        self.items = deque()
+        self.waiting = deque()
+
+    def put(self, item):
+        self.items.append(item)
+        if self.waiting:
+            self.sched.ready.append(self.waiting.popleft())
+
+    def get(self):
+        if not self.items:
+            self.waiting.append(self.sched.current)
+            self.sched.current = None
+            yield
+        return self.items.popleft()
+
+
+class AsyncQueue(GeneratorQueue):
+    # async9: the same thing, awaitable
+    async def get(self):
+        if not self.items:
+            self.waiting.append(self.sched.current)
+            self.sched.current = None
+            await switch()
+        return self.items.popleft()
+
+
+# -------------- switch: n round trips for each of two tasks
+
+
+def switch_scheduler3(n):
+    sched = Scheduler3()
+
+    def step(remaining):
+        if remaining:
+            sched.call_soon(lambda: step(remaining - 1))
+
+    sched.call_soon(lambda: step(n))
+    sched.call_soon(lambda: step(n))
+    sched.run()
+
+
+def switch_scheduler6(n):
+    def pinger(n):
+        for _ in range(n):
+            yield
+
+    sched = Scheduler6()
+    sched.new_task(pinger(n))
+    sched.new_task(pinger(n))
+    sched.run()
+
+
+def switch_coroutines(scheduler_class):
+    async def pinger(n):
+        for _ in range(n):
+            await switch()
+
+    def bench(n):
+        sched = scheduler_class()
+        sched.new_task(pinger(n))
+        sched.new_task(pinger(n))
+        sched.run()
+
+    return bench
+
+
+def switch_asyncio(n):
+    async def pinger(n):
+        for _ in range(n):
+            await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.gather(pinger(n), pinger(n))
+
+    asyncio.run(main())
+
+
+# -------------- spawn: n tasks that do nothing
+
+
+def spawn_scheduler3(n):
+    sched = Scheduler3()
+    for _ in range(n):
+        sched.call_soon(lambda: None)
+    sched.run()
+
+
+def spawn_scheduler6(n):
+    def nothing():
+        return
+        yield
+
+    sched = Scheduler6()
+    for _ in range(n):
+        sched.new_task(nothing())
+    sched.run()
+
+
+def spawn_coroutines(scheduler_class):
+    async def nothing():
+        pass
+
+    def bench(n):
+        sched = scheduler_class()
+        for _ in range(n):
+            sched.new_task(nothing())
+        sched.run()
+
+    return bench
+
+
+def spawn_asyncio(n):
+    async def nothing():
+        pass
+
+    async def main():
+        tasks = [asyncio.ensure_future(nothing()) for _ in range(n)]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+# -------------- timers: n timers that expire within the next 10 milliseconds
+
+
+def delays(n):
+    rng = random.Random(n)
+    return [rng.uniform(0, 0.01) for _ in range(n)]
+
+
+def timers_scheduler3(n):
+    sched = Scheduler3()
+    for delay in delays(n):
+        sched.call_later(delay, lambda: None)
+    sched.run()
+
+
+def timers_scheduler8(n):
+    async def sleeper(delay):
+        await sched.sleep(delay)
+
+    sched = Scheduler8()
+    for delay in delays(n):
+        sched.new_task(sleeper(delay))
+    sched.run()
+
+
+def timers_asyncio(n):
+    async def main():
+        await asyncio.gather(*[asyncio.sleep(delay) for delay in delays(n)])
+
+    asyncio.run(main())
+
+
+# -------------- queue: n items from a producer to a consumer, one task switch per item
+
+
+def queue_scheduler3(n):
+    sched = Scheduler3()
+    q = CallbackQueue(sched)
+
+    def produce(x):
+        if x < n:
+            q.put(x)
+            sched.call_soon(lambda: produce(x + 1))
+        else:
+            q.put(None)
+
+    def consume(item):
+        if item is not None:
+            sched.call_soon(lambda: q.get(consume))
+
+    sched.call_soon(lambda: produce(0))
+    sched.call_soon(lambda: q.get(consume))
+    sched.run()
+
+
+def queue_scheduler6(n):
+    def producer(q):
+        for x in range(n):
+            q.put(x)
+            yield
+        q.put(None)
+
+    def consumer(q):
+        while True:
+            item = yield from q.get()
+            if item is None:
+                break
+
+    sched = Scheduler6()
+    q = GeneratorQueue(sched)
+    sched.new_task(producer(q))
+    sched.new_task(consumer(q))
+    sched.run()
+
+
+def queue_coroutines(scheduler_class):
+    async def producer(q, n):
+        for x in range(n):
+            q.put(x)
+            await switch()
+        q.put(None)
+
+    async def consumer(q):
+        while True:
+            item = await q.get()
+            if item is None:
+                break
+
+    def bench(n):
+        sched = scheduler_class()
+        q = AsyncQueue(sched)
+        sched.new_task(producer(q, n))
+        sched.new_task(consumer(q))
+        sched.run()
+
+    return bench
+
+
+def queue_asyncio(n):
+    async def producer(q):
+        for x in range(n):
+            q.put_nowait(x)
+            await asyncio.sleep(0)
+        q.put_nowait(None)
+
+    async def consumer(q):
+        while True:
+            item = await q.get()
+            if item is None:
+                break
+
+    async def main():
+        q = asyncio.Queue()
+        await asyncio.gather(producer(q), consumer(q))
+
+    asyncio.run(main())
+
+
+# benchmark name -> (operations at --scale 1, operations per n, {scheduler name: function(n) or None})
+BENCHMARKS = {
+    "switch": (
+        100000,
+        2,  # two tasks
+        {
+            "Scheduler3": switch_scheduler3,
+            "Scheduler6": switch_scheduler6,
+            "Scheduler7": switch_coroutines(Scheduler7),
+            "Scheduler8": switch_coroutines(Scheduler8),
+            "asyncio": switch_asyncio,
+        },
+    ),
+    "spawn": (
+        100000,
+        1,
+        {
+            "Scheduler3": spawn_scheduler3,
+            "Scheduler6": spawn_scheduler6,
+            "Scheduler7": spawn_coroutines(Scheduler7),
+            "Scheduler8": spawn_coroutines(Scheduler8),
+            "asyncio": spawn_asyncio,
+        },
+    ),
+    "timers": (
+        50000,
+        1,
+        {
+            "Scheduler3": timers_scheduler3,
+            "Scheduler6": None,
+            "Scheduler7": None,
+            "Scheduler8": timers_scheduler8,
+            "asyncio": timers_asyncio,
+        },
+    ),
+    "queue": (
+        100000,
+        1,
+        {
+            "Scheduler3": queue_scheduler3,
+            "Scheduler6": queue_scheduler6,
+            "Scheduler7": queue_coroutines(Scheduler7),
+            "Scheduler8": queue_coroutines(Scheduler8),
+            "asyncio": queue_asyncio,
+        },
+    ),
+}
+
+
+def measure(func, n, repeat):
+    # best of `repeat` runs: the other runs were disturbed by something else on the machine
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(n)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_benchmarks(scale=1.0, repeat=3, only=None):
+    results = {}
+    for name, (count, ops_per_n, implementations) in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        n = max(1, int(count * scale))
+        results[name] = {}
+        for scheduler, func in implementations.items():
+            if func is None:
+                results[name][scheduler] = None
+                continue
+            seconds = measure(func, n, repeat)
+            results[name][scheduler] = {
+                "ops": n * ops_per_n,
+                "seconds": seconds,
+                "ops_per_second": n * ops_per_n / seconds,
+            }
+            print("%-7s %-11s %10.0f ops/s" % (name, scheduler, n * ops_per_n / seconds), file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark every scheduler generation against asyncio")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of operations")
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of this many runs")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "python": sys.version,
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": run_benchmarks(args.scale, args.repeat, args.only),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()